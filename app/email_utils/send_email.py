@@ -19,7 +19,7 @@ EMAIL_FROM = config('EMAIL_FROM', cast=str)
 env = Environment(loader=FileSystemLoader("./app/email_utils/templates"))
 
 
-def send_email(destination_email: EmailStr, subject: str, html_content):
+def build_message(destination_email: EmailStr, subject: str, html_content):
     message = MIMEMultipart("alternative")
     message["Subject"] = subject
     message["From"] = EMAIL_FROM
@@ -28,6 +28,12 @@ def send_email(destination_email: EmailStr, subject: str, html_content):
     # converts html content to a MIMEText object and add it to the MIMEMultipart message
     message.attach(MIMEText(html_content, "html"))
 
+    return message
+
+
+def send_email(destination_email: EmailStr, subject: str, html_content):
+    message = build_message(destination_email, subject, html_content)
+
     # send your email
     with smtplib.SMTP_SSL(EMAIL_HOST, EMAIL_PORT) as server:
         server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
@@ -56,3 +62,20 @@ def send_password_reset_email(destination_email, token):
         "Solicitud de restauración de contraseña",
         html_content
     )
+
+
+# Sends the invitations through a single SMTP connection (instead of connecting and logging in
+# once per email)
+def send_group_invitation_emails(destination_emails: list[EmailStr], group_name: str):
+    template = env.get_template("group_invitation.html")
+    html_content = template.render({"origin": ORIGIN, "group_name": group_name})
+
+    with smtplib.SMTP_SSL(EMAIL_HOST, EMAIL_PORT) as server:
+        server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+        for destination_email in destination_emails:
+            message = build_message(
+                destination_email,
+                f"Invitación al grupo {group_name}",
+                html_content
+            )
+            server.sendmail(EMAIL_FROM, destination_email, message.as_string())
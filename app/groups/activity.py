@@ -0,0 +1,74 @@
+# Batched, asynchronous activity log of groups.
+#
+# Route handlers only append events to an in-memory bounded buffer (no I/O on the request path).
+# A background task writes the buffer with insert_many when it reaches FLUSH_BATCH_SIZE events
+# or every ACTIVITY_FLUSH_INTERVAL seconds, whatever happens first, and the buffer is drained
+# when the application shuts down. If the database can't keep up and the buffer fills up, the
+# oldest events are dropped (and counted) instead of growing memory without bound.
+
+from collections import deque
+from typing import Any
+import logging
+
+from beanie import PydanticObjectId
+from decouple import config
+
+from .models import GroupActivity
+from ..miscellaneous.background import PeriodicTask
+
+
+ACTIVITY_FLUSH_INTERVAL = config("ACTIVITY_FLUSH_INTERVAL", default=5, cast=float) # Seconds
+ACTIVITY_BUFFER_SIZE = config("ACTIVITY_BUFFER_SIZE", default=10000, cast=int)
+
+FLUSH_BATCH_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityLog(PeriodicTask):
+    run_on_stop = True
+
+    def __init__(self, buffer_size: int, batch_size: int, flush_interval: float):
+        super().__init__(flush_interval)
+        self.batch_size = batch_size
+        self._buffer: deque[GroupActivity] = deque(maxlen=buffer_size)
+        self.dropped = 0
+
+    def record(
+        self,
+        group_id: PydanticObjectId,
+        action: str,
+        actor: PydanticObjectId | None = None,
+        target: PydanticObjectId | str | None = None,
+        **data: Any
+    ):
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+
+        self._buffer.append(GroupActivity(
+            groupId=group_id,
+            action=action,
+            actor=actor,
+            target=target,
+            data=data
+        ))
+
+        if len(self._buffer) >= self.batch_size:
+            self.wake()
+
+    async def flush(self):
+        while self._buffer:
+            batch = [
+                self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))
+            ]
+            try:
+                await GroupActivity.insert_many(batch, ordered=False)
+            except Exception: # pylint: disable=W0718
+                self.dropped += len(batch)
+                logger.exception("Couldn't write %s group activity events", len(batch))
+
+    async def run_once(self):
+        await self.flush()
+
+
+activity_log = ActivityLog(ACTIVITY_BUFFER_SIZE, FLUSH_BATCH_SIZE, ACTIVITY_FLUSH_INTERVAL)
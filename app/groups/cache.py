@@ -0,0 +1,170 @@
+# In-process LRU cache of Group documents, used by fetch_group for read (GET) requests.
+#
+# Every write to a group (replace, update/set or delete through beanie) invalidates its entry on
+# this worker right away, and the invalidation is published through the realtime broker so the
+# other workers drop their copy as well (this needs the mongo backend, see GROUP_CACHE_SIZE).
+# Entries also expire after GROUP_CACHE_MAX_AGE seconds, which bounds staleness if an
+# invalidation is ever missed.
+#
+# A read that started before an invalidation of the same group could otherwise cache the copy it
+# loaded, which may predate the write. Invalidations are numbered, readers take the number before
+# loading (generation) and put refuses copies loaded before the last invalidation of the group.
+#
+# Routes that authorize the user from the rosters of the group don't read it from this cache (see
+# groups/dependencies.py), so a removed member or admin loses access as soon as the write is done.
+
+from collections import OrderedDict
+import logging
+import time
+
+from decouple import config
+
+from ..realtime.broker import broker, REALTIME_BACKEND
+from ..miscellaneous.background import BackgroundTask
+
+
+# A size of 0 disables the cache. Invalidations only reach the other workers with the mongo
+# realtime backend (REALTIME_BACKEND=mongo), with the memory backend each worker would serve the
+# groups other workers modified until their entries expire. So when running more than one worker
+# (WEB_CONCURRENCY, the variable uvicorn and gunicorn read for their number of workers) the cache
+# is disabled unless the mongo backend is set
+GROUP_CACHE_SIZE = config("GROUP_CACHE_SIZE", default=1000, cast=int)
+GROUP_CACHE_MAX_AGE = config("GROUP_CACHE_MAX_AGE", default=30, cast=float) # Seconds
+
+WEB_CONCURRENCY = config("WEB_CONCURRENCY", default=1, cast=int)
+
+INVALIDATION_CHANNEL = "cache:groups"
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCache(BackgroundTask):
+    def __init__(self, max_size: int, max_age: float):
+        super().__init__()
+        self.max_size = max_size
+        self.max_age = max_age
+        self._entries: OrderedDict[str, tuple] = OrderedDict() # id -> (group, cached at)
+
+        self._generation = 0 # Number of the last invalidation
+        self._invalidated_at: OrderedDict[str, int] = OrderedDict() # id -> last invalidation
+        self._forgotten_generation = 0 # Last invalidation number no longer tracked per group
+
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.served_age_total = 0.0 # Sum of the ages of the entries served, in seconds
+        self.served_age_max = 0.0
+
+    # Copies the group so requests can modify the document they get (e.g. the lists of links)
+    # without modifying the cached one
+    @staticmethod
+    def _copy(group):
+        return group.model_copy(update={
+            "admins": list(group.admins),
+            "members": list(group.members),
+            "joinRequests": list(group.joinRequests)
+        })
+
+    def get(self, group_id: str):
+        if not (entry := self._entries.get(group_id)):
+            self.misses += 1
+            return None
+
+        group, cached_at = entry
+        age = time.monotonic() - cached_at
+        if age > self.max_age:
+            del self._entries[group_id]
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(group_id)
+        self.hits += 1
+        self.served_age_total += age
+        self.served_age_max = max(self.served_age_max, age)
+        return self._copy(group)
+
+    # Must be taken before loading the group that will be put
+    def generation(self) -> int:
+        return self._generation
+
+    def put(self, group, generation: int):
+        group_id = str(group.id)
+        if generation < max(
+            self._invalidated_at.get(group_id, 0), self._forgotten_generation
+        ):
+            return
+
+        self._entries[group_id] = (self._copy(group), time.monotonic())
+        self._entries.move_to_end(group_id)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, group_id: str):
+        self._generation += 1
+        self._invalidated_at[group_id] = self._generation
+        self._invalidated_at.move_to_end(group_id)
+        # Only the most recent invalidations are tracked per group, reads that started before
+        # the forgotten ones aren't cached at all
+        if len(self._invalidated_at) > self.max_size:
+            _, self._forgotten_generation = self._invalidated_at.popitem(last=False)
+
+        if self._entries.pop(group_id, None):
+            self.invalidations += 1
+
+    # Invalidates the group on this worker and notifies the other ones
+    async def invalidate_everywhere(self, group_id: str):
+        self.invalidate(group_id)
+        await broker.publish(INVALIDATION_CHANNEL, "invalidate", {"groupId": group_id})
+
+    def clear(self):
+        self._generation += 1
+        self._forgotten_generation = self._generation
+        self._invalidated_at.clear()
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    # Listens to the invalidations published by the other workers
+    async def _run(self):
+        subscription = broker.subscribe(INVALIDATION_CHANNEL)
+        try:
+            while True:
+                event = await subscription.queue.get()
+                self.invalidate(event["data"]["groupId"])
+
+                # If invalidations were dropped there is no way to know which entries are
+                # stale, so drops all of them
+                if subscription.lagged:
+                    subscription.lagged = False
+                    self.clear()
+        finally:
+            broker.unsubscribe(subscription)
+
+    def stats(self) -> dict:
+        served = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxSize": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": self.hits / served if served else 0.0,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "maxAge": self.max_age,
+            "avgServedAge": self.served_age_total / self.hits if self.hits else 0.0,
+            "maxServedAge": self.served_age_max
+        }
+
+
+def get_group_cache_size() -> int:
+    if GROUP_CACHE_SIZE and WEB_CONCURRENCY > 1 and REALTIME_BACKEND != "mongo":
+        logger.warning(
+            "The group cache is disabled: with %s workers it needs REALTIME_BACKEND=mongo",
+            WEB_CONCURRENCY
+        )
+        return 0
+    return GROUP_CACHE_SIZE
+
+
+group_cache = GroupCache(get_group_cache_size(), GROUP_CACHE_MAX_AGE)
@@ -1,12 +1,59 @@
-from fastapi import HTTPException, status
+from typing import Annotated
+import asyncio
+
+from fastapi import HTTPException, status, Depends, Request
 
 from .models import Group
+from .cache import group_cache
+from ..registration.models import User
+from ..miscellaneous.loader import DocumentLoader
+from ..miscellaneous.dependencies import get_loader, get_current_user_id
+
+
+# Read (GET) requests are served from the hot groups cache when possible. Requests that modify
+# the group always read it from the database, so they never write based on a stale copy
+async def fetch_group(
+    groupId: str,
+    request: Request,
+    loader: Annotated[DocumentLoader, Depends(get_loader)]
+):
+    return await load_group(groupId, loader, use_cache=request.method == "GET")
+
+
+async def load_group(group_id: str, loader: DocumentLoader, use_cache: bool = False):
+    if use_cache and (group := group_cache.get(group_id)):
+        loader.prime(group)
+        return group
 
-async def fetch_group(groupId: str):
-    if not (group := await Group.get(groupId)):
+    generation = group_cache.generation()
+    if not (group := await loader.load(Group, group_id)):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="El grupo solicitado no existe"
         )
 
+    if use_cache:
+        group_cache.put(group, generation)
+
+    return group
+
+
+# For routes that also depend on get_current_user: loads the group and the current user
+# concurrently, so get_current_user later finds the user already loaded. Errors loading the user
+# are ignored here, get_current_user raises them.
+# These routes authorize the user from the rosters of the group, so the group is always read from
+# the database, never from the cache
+async def fetch_group_and_prefetch_user(
+    groupId: str,
+    user_id: Annotated[str, Depends(get_current_user_id)],
+    loader: Annotated[DocumentLoader, Depends(get_loader)]
+):
+    group, _ = await asyncio.gather(
+        load_group(groupId, loader),
+        loader.load(User, user_id),
+        return_exceptions=True
+    )
+    if isinstance(group, Exception):
+        raise group
+
     return group
@@ -3,3 +3,15 @@ from typing import Literal
 AccessibilityEnum = Literal["public", "private"]
 
 WhoCanPublishEnum = Literal["anyone", "members", "onlyAdmins"]
+
+RosterEnum = Literal["admins", "members", "joinRequests"]
+
+ExportFormatEnum = Literal["ndjson", "csv"]
+
+ImportRowStatusEnum = Literal["added", "alreadyInGroup", "invited", "invalid", "duplicated"]
+
+ActivityActionEnum = Literal[
+    "groupCreated", "groupUpdated", "groupImageUpdated", "groupDeleted", "memberJoined",
+    "joinRequestCreated", "joinRequestApproved", "adminAdded", "memberLeft", "memberRemoved",
+    "membersImported"
+]
@@ -1,11 +1,17 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Any
 
 from pydantic import Field
 from pydantic.networks import HttpUrl
-from beanie import Document, before_event, Replace, Link
+from pymongo import IndexModel, DESCENDING
+from beanie import (
+    Document, before_event, after_event, Insert, Replace, Update, Delete, Link, PydanticObjectId
+)
 
 from . import enums
+from .cache import group_cache
 from ..registration.models import User
+from ..registration import enums as registration_enums
 
 
 class Group(Document):
@@ -19,6 +25,12 @@ class Group(Document):
     admins: list[Link[User]]
     members: list[Link[User]] = []
     joinRequests: list[Link[User]] = []
+    # Denormalized sizes of the lists above, so clients can render counters and badges
+    # without loading the rosters. They are computed on insert/replace, and derived from the lists
+    # on the server after every membership change (see apply_membership_change in utils.py)
+    memberCount: int = 0
+    adminCount: int = 0
+    pendingRequestCount: int = 0
     createdAt: datetime = Field(default_factory=datetime.utcnow)
     updatedAt: datetime = Field(default_factory=datetime.utcnow)
 
@@ -26,5 +38,99 @@ class Group(Document):
     def update_updatedAt_field(self):
         self.updatedAt = datetime.utcnow()
 
+    @before_event(Insert, Replace)
+    def update_counters(self):
+        self.memberCount = len(self.members)
+        self.adminCount = len(self.admins)
+        self.pendingRequestCount = len(self.joinRequests)
+
+    @after_event(Replace, Update, Delete)
+    async def invalidate_cache(self):
+        await group_cache.invalidate_everywhere(str(self.id))
+
     class Settings:
         name = "groups"
+        # Edits of the group check and renew the revision, so concurrent edits can't clobber each
+        # other (the second one fails with RevisionIdWasChanged). Membership changes are atomic
+        # updates of the rosters instead, which don't check it
+        use_revision = True
+        # For finding the groups of a user (links are stored as DBRefs), and the ones that
+        # changed since a moment (delta sync), and the groups the user asked to join
+        indexes = [
+            IndexModel([("admins.$id", 1), ("updatedAt", 1)]),
+            IndexModel([("members.$id", 1), ("updatedAt", 1)]),
+            IndexModel([("joinRequests.$id", 1)])
+        ]
+
+
+# Materialized recommendations: how many users of each division and academic level belong to
+# each group. Recomputed periodically and kept roughly up to date between runs with increments
+# on membership changes (see recommendations.py). Group fields needed for listing are copied
+# here so recommendations can be served with a single query
+class GroupRecommendation(Document):
+    division: str
+    academicLevel: registration_enums.AcademicLevelEnum | None = None
+    groupId: PydanticObjectId
+    score: int = 0
+    name: str
+    groupImage: str | None = None
+    groupColor: str | None = None
+    accessibility: enums.AccessibilityEnum
+    memberCount: int = 0
+    computedAt: datetime = Field(default_factory=datetime.utcnow)
+
+    class Settings:
+        name = "groupRecommendations"
+        indexes = [
+            IndexModel([("division", 1), ("academicLevel", 1), ("groupId", 1)], unique=True),
+            IndexModel([("division", 1), ("academicLevel", 1), ("score", DESCENDING)]),
+            IndexModel([("groupId", 1)])
+        ]
+
+
+# When the last periodic refresh of the recommendations started. A single document, claimed
+# atomically by the worker that runs the refresh, so only one worker runs it per interval
+class RecommendationsRefresh(Document):
+    id: str
+    startedAt: datetime
+
+    class Settings:
+        name = "recommendationsRefresh"
+
+
+# Audit trail of membership and administration changes of groups. Written in batches by the
+# activity log (see activity.py), never directly from the request handlers
+class GroupActivity(Document):
+    groupId: PydanticObjectId
+    action: enums.ActivityActionEnum
+    actor: PydanticObjectId | None = None
+    target: PydanticObjectId | None = None
+    data: dict[str, Any] = {}
+    createdAt: datetime = Field(default_factory=datetime.utcnow)
+
+    class Settings:
+        name = "groupActivity"
+        indexes = [
+            IndexModel([("groupId", 1), ("createdAt", DESCENDING), ("_id", DESCENDING)])
+        ]
+
+
+# Clients that haven't synced in longer than this get a full snapshot instead of a delta
+MEMBERSHIP_TOMBSTONE_TTL = timedelta(days=30)
+
+
+# Record of a user losing a membership (leaving, being removed or the group being deleted), so
+# delta sync can tell clients which groups to drop from their lists
+class MembershipTombstone(Document):
+    userId: PydanticObjectId
+    groupId: PydanticObjectId
+    createdAt: datetime = Field(default_factory=datetime.utcnow)
+
+    class Settings:
+        name = "membershipTombstones"
+        indexes = [
+            IndexModel([("userId", 1), ("createdAt", 1)]),
+            IndexModel(
+                [("createdAt", 1)], expireAfterSeconds=MEMBERSHIP_TOMBSTONE_TTL.total_seconds()
+            )
+        ]
@@ -0,0 +1,160 @@
+# Group recommendations by division and academic level.
+#
+# A background job periodically aggregates the memberships of every group by the division and
+# academic level of its users into the groupRecommendations collection. Between runs membership
+# changes increment or decrement the affected score, so the endpoint can serve recommendations
+# with indexed reads instead of aggregating on every request.
+#
+# Every worker runs the refresher, but each run is claimed first in the recommendationsRefresh
+# collection: a worker only refreshes if no other worker started a refresh in the last interval,
+# so the aggregation runs once per interval whatever the number of workers.
+
+from collections import Counter
+from datetime import datetime, timedelta
+
+from decouple import config
+from beanie import PydanticObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from .models import Group, GroupRecommendation, RecommendationsRefresh
+from ..registration.models import User
+from ..miscellaneous.background import PeriodicTask
+
+
+RECOMMENDATIONS_REFRESH_INTERVAL = config(
+    "RECOMMENDATIONS_REFRESH_INTERVAL", default=60 * 60, cast=int
+) # Seconds
+
+RECOMMENDATIONS_PER_BUCKET = 50 # Groups kept per (division, academic level)
+
+REFRESH_CLAIM_ID = "recommendations"
+
+
+# Claims the next refresh, returns False if another worker started one less than interval
+# seconds ago. The claim only matches a stale document, so when the document is fresh the upsert
+# tries to insert a second one with the same id and fails
+async def claim_refresh(interval: int) -> bool:
+    now = datetime.utcnow()
+    try:
+        await RecommendationsRefresh.get_motor_collection().update_one(
+            {"_id": REFRESH_CLAIM_ID, "startedAt": {"$lte": now - timedelta(seconds=interval)}},
+            {"$set": {"startedAt": now}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+
+    return True
+
+
+async def refresh_recommendations():
+    started_at = datetime.utcnow()
+
+    await Group.get_motor_collection().aggregate([
+        {"$project": {
+            "name": 1, "groupImage": 1, "groupColor": 1, "accessibility": 1, "memberCount": 1,
+            "users": {"$concatArrays": ["$admins", "$members"]}
+        }},
+        {"$unwind": "$users"},
+        # Links are stored as DBRefs, whose $id field can't be referenced with a field path
+        {"$set": {"userId": {"$getField": {"field": {"$literal": "$id"}, "input": "$users"}}}},
+        {"$lookup": {
+            "from": User.get_collection_name(),
+            "localField": "userId",
+            "foreignField": "_id",
+            "pipeline": [{"$project": {"division": 1, "academicLevel": 1}}],
+            "as": "user"
+        }},
+        {"$unwind": "$user"},
+        {"$group": {
+            "_id": {
+                "division": "$user.division",
+                "academicLevel": "$user.academicLevel",
+                "groupId": "$_id"
+            },
+            "score": {"$sum": 1},
+            "name": {"$first": "$name"},
+            "groupImage": {"$first": "$groupImage"},
+            "groupColor": {"$first": "$groupColor"},
+            "accessibility": {"$first": "$accessibility"},
+            "memberCount": {"$first": "$memberCount"}
+        }},
+        {"$setWindowFields": {
+            "partitionBy": {"division": "$_id.division", "academicLevel": "$_id.academicLevel"},
+            "sortBy": {"score": -1},
+            "output": {"rank": {"$documentNumber": {}}}
+        }},
+        {"$match": {"rank": {"$lte": RECOMMENDATIONS_PER_BUCKET}}},
+        {"$project": {
+            "_id": 0,
+            "division": "$_id.division",
+            "academicLevel": "$_id.academicLevel",
+            "groupId": "$_id.groupId",
+            "score": 1, "name": 1, "groupImage": 1, "groupColor": 1, "accessibility": 1,
+            "memberCount": 1,
+            "computedAt": started_at
+        }},
+        {"$merge": {
+            "into": GroupRecommendation.get_collection_name(),
+            "on": ["division", "academicLevel", "groupId"],
+            "whenMatched": "replace",
+            "whenNotMatched": "insert"
+        }}
+    ]).to_list(None)
+
+    # Removes recommendations this run didn't produce (deleted groups, groups that fell out of
+    # the top of their bucket, etc)
+    await GroupRecommendation.find(GroupRecommendation.computedAt < started_at).delete()
+
+
+# Increments (or decrements) the scores of the group for the divisions and academic levels of the
+# users, with a single query for the users and a single bulk write (one update per division and
+# academic level). Meant to run as a background task after a membership change. Only increments
+# create missing entries, the periodic refresh takes care of the rest
+async def update_recommendation_scores(group: Group, user_ids: list, delta: int):
+    buckets = Counter()
+    async for user in User.get_motor_collection().find(
+        {"_id": {"$in": [PydanticObjectId(user_id) for user_id in user_ids]}},
+        {"division": 1, "academicLevel": 1}
+    ):
+        buckets[(user.get("division"), user.get("academicLevel"))] += 1
+
+    if not buckets:
+        return
+
+    now = datetime.utcnow()
+    await GroupRecommendation.get_motor_collection().bulk_write([
+        UpdateOne(
+            {"division": division, "academicLevel": academic_level, "groupId": group.id},
+            {
+                "$inc": {"score": delta * count},
+                "$set": {
+                    "name": group.name,
+                    "groupImage": group.groupImage,
+                    "groupColor": group.groupColor,
+                    "accessibility": group.accessibility,
+                    "memberCount": group.memberCount,
+                    "computedAt": now
+                }
+            },
+            upsert=delta > 0
+        )
+        for (division, academic_level), count in buckets.items()
+    ], ordered=False)
+
+
+async def delete_group_recommendations(group: Group):
+    await GroupRecommendation.find(GroupRecommendation.groupId == group.id).delete()
+
+
+class RecommendationsRefresher(PeriodicTask):
+    run_on_start = True
+    failure_message = "Couldn't refresh the group recommendations"
+
+    async def run_once(self):
+        if await claim_refresh(self.interval):
+            await refresh_recommendations()
+
+
+recommendations_refresher = RecommendationsRefresher(RECOMMENDATIONS_REFRESH_INTERVAL)
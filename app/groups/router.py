@@ -1,21 +1,40 @@
 from typing import Annotated
+from datetime import datetime
+import asyncio
 import textwrap
 import os
 
-from fastapi import APIRouter, HTTPException, status, Depends, Form, UploadFile, Body
-from pydantic.networks import HttpUrl
+from fastapi import (
+    APIRouter, HTTPException, status, Depends, Form, UploadFile, Body, Query, BackgroundTasks
+)
+from fastapi.responses import StreamingResponse, JSONResponse
+from pydantic import TypeAdapter, ValidationError
+from pydantic.networks import HttpUrl, EmailStr
+from beanie import PydanticObjectId
+from beanie.operators import NotIn
 
 from . import schemas, enums
-from .models import Group
-from .dependencies import fetch_group
-from .utils import check_user_is_group_admin
-from ..miscellaneous.utils import get_media_root
+from .models import Group, GroupRecommendation, GroupActivity
+from .activity import activity_log
+from .recommendations import delete_group_recommendations
+from .dependencies import fetch_group, fetch_group_and_prefetch_user
+from .utils import (
+    check_user_is_group_admin, apply_membership_side_effects, fetch_users, stream_roster,
+    gzip_stream, read_csv_emails, add_members_by_email, write_membership_tombstones, user_ref,
+    apply_membership_change, IMPORT_BATCH_SIZE
+)
+from ..miscellaneous.utils import get_media_root, encode_cursor, keyset_query
 from ..registration.models import User
-from ..miscellaneous.dependencies import get_current_user, validate_upload_file
+from ..miscellaneous.dependencies import get_current_user, get_loader, validate_upload_file
+from ..miscellaneous.loader import DocumentLoader
+from ..realtime.broker import broker, group_channel
+from ..email_utils.send_email import send_group_invitation_emails
 
 
 MEDIA_ROOT = get_media_root()
 
+email_adapter = TypeAdapter(EmailStr)
+
 router = APIRouter(prefix="/groups", tags=["groups"])
 
 
@@ -45,6 +64,7 @@ async def create_group(
         admins = [user]
     )
     new_group = await new_group.insert()
+    activity_log.record(new_group.id, "groupCreated", user.id)
 
     # If recieved groupImage in request validates and saves it in file system
     if groupImage:
@@ -54,39 +74,69 @@ async def create_group(
         with open(MEDIA_ROOT + path, "wb") as new_file:
             new_file.write(await groupImage.read())
 
-        new_group.groupImage = "/media" + path
-        await new_group.replace()
+        await new_group.set({Group.groupImage: "/media" + path})
 
     return new_group
 
 
+# Recommends groups based on the division and academic level of the user, served from the
+# precomputed recommendations. Groups the user already belongs to or asked to join are left out
+@router.get("/recommended/", response_model=schemas.RecommendedGroupsResponse)
+async def get_recommended_groups(
+    user: Annotated[User, Depends(get_current_user)],
+    limit: Annotated[int, Query(ge=1, le=50)] = 20
+):
+    own_groups = await Group.find(
+        {"$or": [
+            {"admins.$id": user.id}, {"members.$id": user.id}, {"joinRequests.$id": user.id}
+        ]},
+        projection_model=schemas.GroupIdProjection
+    ).to_list()
+
+    return {"groups": await GroupRecommendation.find(
+        GroupRecommendation.division == user.division,
+        GroupRecommendation.academicLevel == user.academicLevel,
+        NotIn(GroupRecommendation.groupId, [group.id for group in own_groups])
+    ).sort(-GroupRecommendation.score).limit(limit).to_list()}
+
+
 # Path operation for returning all information of a group
 @router.get("/{groupId}/", response_model=schemas.GroupResponse)
-async def get_group_info(group: Annotated[Group, Depends(fetch_group)]):
-    await group.fetch_link(Group.admins)
-    await group.fetch_link(Group.members)
+async def get_group_info(
+    group: Annotated[Group, Depends(fetch_group)],
+    loader: Annotated[DocumentLoader, Depends(get_loader)]
+):
+    group.admins, group.members = await asyncio.gather(
+        fetch_users(loader, group.admins),
+        fetch_users(loader, group.members)
+    )
     return group
 
 
 @router.patch("/{groupId}/")
 async def patch_group(
     groupPatch: schemas.GroupPatch,
-    group: Annotated[Group, Depends(fetch_group)],
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
     user: Annotated[User, Depends(get_current_user)]
 ):
     check_user_is_group_admin(user, group)
 
-    for key, value in groupPatch.model_dump(exclude_unset=True).items():
-        setattr(group, key, value)
-    await group.replace()
-    await group.sync()
+    # Only sets the patched fields, checking the group wasn't modified since it was fetched and
+    # getting back the updated document in the same operation
+    await group.set({
+        **groupPatch.model_dump(exclude_unset=True),
+        Group.updatedAt: datetime.utcnow()
+    })
+    activity_log.record(
+        group.id, "groupUpdated", user.id, fields=list(groupPatch.model_dump(exclude_unset=True))
+    )
 
     return {"msg": "ok"}
 
 
 @router.patch("/{groupId}/group-image/")
 async def update_profile_image(
-    group: Annotated[Group, Depends(fetch_group)],
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
     group_image: Annotated[UploadFile, Depends(validate_upload_file)],
     user: Annotated[User, Depends(get_current_user)]
 ):
@@ -103,8 +153,8 @@ async def update_profile_image(
             new_file.write(await group_image.read())
 
         group_image = "/media" + path
-        group.groupImage = group_image
-        await group.replace()
+        await group.set({Group.groupImage: group_image, Group.updatedAt: datetime.utcnow()})
+        activity_log.record(group.id, "groupImageUpdated", user.id)
 
     except Exception as exc:
         raise HTTPException(
@@ -117,8 +167,9 @@ async def update_profile_image(
 
 @router.delete("/{groupId}/")
 async def delete_group(
-    group: Annotated[Group, Depends(fetch_group)],
-    user: Annotated[User, Depends(get_current_user)]
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
+    user: Annotated[User, Depends(get_current_user)],
+    background_tasks: BackgroundTasks
 ):
     check_user_is_group_admin(user, group)
 
@@ -127,6 +178,13 @@ async def delete_group(
         os.remove(MEDIA_ROOT + group.groupImage[6:])
 
     await group.delete()
+    await write_membership_tombstones(
+        group, [link.ref.id for link in group.admins + group.members]
+    )
+    background_tasks.add_task(delete_group_recommendations, group)
+    activity_log.record(group.id, "groupDeleted", user.id)
+
+    await broker.publish(group_channel(group.id), "groupDeleted", {"groupId": str(group.id)})
 
     return {"msg": "ok"}
 
@@ -134,128 +192,268 @@ async def delete_group(
 @router.get("/{groupId}/admins/", response_model=schemas.GroupUsersResponse)
 async def get_group_admins(
     group: Annotated[Group, Depends(fetch_group)],
+    loader: Annotated[DocumentLoader, Depends(get_loader)]
 ):
-    await group.fetch_link(Group.admins)
-    return {"users": group.admins}
+    return {"users": await fetch_users(loader, group.admins)}
 
 
 @router.get("/{groupId}/members/", response_model=schemas.GroupUsersResponse)
 async def get_group_members(
     group: Annotated[Group, Depends(fetch_group)],
+    loader: Annotated[DocumentLoader, Depends(get_loader)]
+):
+    return {"users": await fetch_users(loader, group.members)}
+
+
+# Exports a roster of the group (as a file download). Rows are streamed as they are read from
+# the database, so the download starts right away and memory stays constant for any group size
+@router.get("/{groupId}/export/")
+async def export_group_roster(
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
+    user: Annotated[User, Depends(get_current_user)],
+    roster: enums.RosterEnum = "members",
+    export_format: Annotated[enums.ExportFormatEnum, Query(alias="format")] = "ndjson",
+    gzip: bool = False
 ):
-    await group.fetch_link(Group.members)
-    return {"users": group.members}
+    check_user_is_group_admin(user, group)
+
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    filename = f"{roster}-{group.id}.{export_format}"
+    content = stream_roster(getattr(group, roster), export_format)
+
+    if gzip:
+        media_type = "application/gzip"
+        filename += ".gz"
+        content = gzip_stream(content)
+
+    return StreamingResponse(
+        content,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+# Adds as members the users in a CSV file of emails (e.g. a class roster). The file is read (and
+# validated) entirely before adding anyone and then processed in batches, emails without an
+# account are sent an invitation after responding, and the result of every row is returned.
+# If a batch can't be applied (the group is receiving too many changes) the import stops there,
+# responding with a 409 that tells the rows already processed, whose side effects still apply
+@router.post("/{groupId}/import-members/", response_model=schemas.ImportMembersResponse)
+async def import_members(
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
+    user: Annotated[User, Depends(get_current_user)],
+    file: UploadFile,
+    background_tasks: BackgroundTasks
+):
+    check_user_is_group_admin(user, group)
+
+    rows = []
+    results = []
+    seen_emails = set()
+    for row_number, email in list(read_csv_emails(file.file)):
+        try:
+            email = email_adapter.validate_python(email)
+        except ValidationError:
+            results.append({"row": row_number, "email": email, "status": "invalid"})
+            continue
+
+        if email in seen_emails:
+            results.append({"row": row_number, "email": email, "status": "duplicated"})
+            continue
+        seen_emails.add(email)
+
+        rows.append((row_number, email))
+
+    added_ids = []
+    stopped_at = None
+    for i in range(0, len(rows), IMPORT_BATCH_SIZE):
+        batch = rows[i:i + IMPORT_BATCH_SIZE]
+        try:
+            batch_results, batch_added_ids = await add_members_by_email(group, batch)
+        except HTTPException as exc:
+            if exc.status_code != status.HTTP_409_CONFLICT:
+                raise
+            stopped_at = batch[0][0]
+            break
+
+        results += batch_results
+        added_ids += batch_added_ids
+
+    if stopped_at is not None:
+        results = [result for result in results if result["row"] < stopped_at]
+
+    results.sort(key=lambda result: result["row"])
+    added = len(added_ids)
+    to_invite = [result["email"] for result in results if result["status"] == "invited"]
+
+    if to_invite:
+        background_tasks.add_task(send_group_invitation_emails, to_invite, group.name)
+
+    if added:
+        # The group's channel gets a single summary instead of an event per added user
+        await apply_membership_side_effects(
+            group, "memberImported", added_ids, background_tasks, score_delta=1,
+            notify_group=False
+        )
+        activity_log.record(
+            group.id, "membersImported", user.id, added=added, invited=len(to_invite)
+        )
+        await broker.publish(group_channel(group.id), "membersImported", {
+            "groupId": str(group.id),
+            "added": added,
+            "memberCount": group.memberCount,
+            "pendingRequestCount": group.pendingRequestCount
+        })
+
+    # Returned as a response (instead of raised) so the background tasks of the rows already
+    # processed still run
+    if stopped_at is not None:
+        return JSONResponse(status_code=status.HTTP_409_CONFLICT, content={"detail": (
+            f"El grupo está recibiendo demasiados cambios, la importación se detuvo en la fila "
+            f"{stopped_at} ({added} miembros agregados, {len(to_invite)} invitaciones enviadas). "
+            f"Intenta de nuevo con las filas restantes en unos momentos"
+        )})
+
+    return {"added": added, "invited": len(to_invite), "results": results}
 
 
 @router.post("/{groupId}/join/")
 async def join_group(
-    group: Annotated[Group, Depends(fetch_group)],
-    user: Annotated[User, Depends(get_current_user)]
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
+    user: Annotated[User, Depends(get_current_user)],
+    background_tasks: BackgroundTasks
 ):
-    # Checks that user hasn't already joined this group neither is in the list of users
-    # that have requested to join
-    if (
-        user.id in [user.ref.id for user in group.members] or
-        user.id in [user.ref.id for user in group.admins] or
-        user.id in [user.ref.id for user in group.joinRequests]
-    ):
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=textwrap.dedent("""
-                Ya estas dentro de este grupo o en la lista de usuarios que han solicitado
-                unirse
-            """).replace("\n", " ").strip()
+    def join(group: Group) -> tuple[dict, dict]:
+        # Checks that user hasn't already joined this group neither is in the list of users
+        # that have requested to join
+        if (
+            user.id in [user.ref.id for user in group.members] or
+            user.id in [user.ref.id for user in group.admins] or
+            user.id in [user.ref.id for user in group.joinRequests]
+        ):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=textwrap.dedent("""
+                    Ya estas dentro de este grupo o en la lista de usuarios que han solicitado
+                    unirse
+                """).replace("\n", " ").strip()
+            )
+
+        # If group accessibility is public just add user to members list, if it's private then
+        # add user to list of users that have requested to join
+        roster = "members" if group.accessibility == "public" else "joinRequests"
+        user_joined = user_ref(user.id)
+        return (
+            {name: {"$ne": user_joined} for name in ("admins", "members", "joinRequests")},
+            {"$addToSet": {roster: user_joined}}
         )
 
-    # If group accessibility is public just add user tu members list
-    if group.accessibility == "public":
-        group.members.append(user)
-        await group.replace()
+    await apply_membership_change(group, join)
+
+    if user.id in [user.ref.id for user in group.members]:
+        await apply_membership_side_effects(
+            group, "memberJoined", [user.id], background_tasks, score_delta=1
+        )
+        activity_log.record(group.id, "memberJoined", user.id)
         return {"msg": "Te uniste al grupo exitosamente"}
 
-    # If group accessibility is private then add user to list of users that have requested
-    # to join
-    group.joinRequests.append(user)
-    await group.replace()
+    await apply_membership_side_effects(group, "joinRequestCreated", [user.id], background_tasks)
+    activity_log.record(group.id, "joinRequestCreated", user.id)
     return {"msg": "Solicitud enviada exitosamente"}
 
 
 @router.get("/{groupId}/join-requests/", response_model=schemas.GroupUsersResponse)
 async def get_group_join_requests(
-    group: Annotated[Group, Depends(fetch_group)],
-    user: Annotated[User, Depends(get_current_user)]
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
+    user: Annotated[User, Depends(get_current_user)],
+    loader: Annotated[DocumentLoader, Depends(get_loader)]
 ):
     check_user_is_group_admin(user, group)
 
-    await group.fetch_link(Group.joinRequests)
-    return {"users": group.joinRequests}
+    return {"users": await fetch_users(loader, group.joinRequests)}
 
 
 @router.post("/{groupId}/approve-join-request/")
 async def approve_join_request(
-    group: Annotated[Group, Depends(fetch_group)],
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
     user: Annotated[User, Depends(get_current_user)],
-    userToApprove: Annotated[str, Body()]
+    userToApprove: Annotated[str, Body()],
+    background_tasks: BackgroundTasks
 ):
     check_user_is_group_admin(user, group)
 
-    try:
-        i_user_to_appr = [str(user.ref.id) for user in group.joinRequests].index(userToApprove)
-    except ValueError as exc:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=textwrap.dedent("""
-                No se encontró ningún usuario en la lista de solicitudes de unión al grupo
-                que corresponda con el id proporcionado
-            """).replace("\n", " ").strip()
-        ) from exc
+    # Moves the reference itself, there's no need to fetch the approved user
+    def approve(group: Group) -> tuple[dict, dict]:
+        if userToApprove not in [str(user.ref.id) for user in group.joinRequests]:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=textwrap.dedent("""
+                    No se encontró ningún usuario en la lista de solicitudes de unión al grupo
+                    que corresponda con el id proporcionado
+                """).replace("\n", " ").strip()
+            )
+
+        user_approved = user_ref(userToApprove)
+        return (
+            {"joinRequests": user_approved},
+            {"$pull": {"joinRequests": user_approved}, "$addToSet": {"members": user_approved}}
+        )
 
-    user_approved = await User.get(group.joinRequests.pop(i_user_to_appr).ref.id)
-    group.members.append(user_approved)
-    await group.replace()
+    await apply_membership_change(group, approve)
+    user_approved = PydanticObjectId(userToApprove)
+    await apply_membership_side_effects(
+        group, "joinRequestApproved", [user_approved], background_tasks, score_delta=1
+    )
+    activity_log.record(group.id, "joinRequestApproved", user.id, user_approved)
 
     return {"msg": "ok"}
 
 
 @router.post("/{groupId}/make-admin/")
 async def make_member_admin(
-    group: Annotated[Group, Depends(fetch_group)],
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
     user: Annotated[User, Depends(get_current_user)],
-    member_granted: Annotated[str, Body()]
+    member_granted: Annotated[str, Body()],
+    background_tasks: BackgroundTasks
 ):
     check_user_is_group_admin(user, group)
 
-    try:
-        i_member = [str(user.ref.id) for user in group.members].index(member_granted)
-    except ValueError as exc:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=textwrap.dedent("""
-                No se encontró en la lista de miembros ningún usuario que corresponda con el
-                id proporcionado
-            """).replace("\n", " ").split()
-        ) from exc
+    def grant_admin(group: Group) -> tuple[dict, dict]:
+        if member_granted not in [str(user.ref.id) for user in group.members]:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=textwrap.dedent("""
+                    No se encontró en la lista de miembros ningún usuario que corresponda con el
+                    id proporcionado
+                """).replace("\n", " ").split()
+            )
+
+        member = user_ref(member_granted)
+        return (
+            {"members": member},
+            {"$pull": {"members": member}, "$addToSet": {"admins": member}}
+        )
 
-    member_granted = await User.get(group.members.pop(i_member).ref.id)
-    group.admins.append(member_granted)
-    await group.replace()
+    await apply_membership_change(group, grant_admin)
+    member_granted = PydanticObjectId(member_granted)
+    await apply_membership_side_effects(group, "adminAdded", [member_granted], background_tasks)
+    activity_log.record(group.id, "adminAdded", user.id, member_granted)
 
     return {"msg": "ok"}
 
 
 @router.post("/{groupId}/left/")
 async def left_group(
-    group: Annotated[Group, Depends(fetch_group)],
-    user: Annotated[User, Depends(get_current_user)]
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
+    user: Annotated[User, Depends(get_current_user)],
+    background_tasks: BackgroundTasks
 ):
-    try:
-        i_user = [user.ref.id for user in group.members].index(user.id)
-        del group.members[i_user]
-
-    except ValueError as exc:
-        try:
-            i_user = [user.ref.id for user in group.admins].index(user.id)
+    def leave(group: Group) -> tuple[dict, dict]:
+        user_left = user_ref(user.id)
+        if user.id in [user.ref.id for user in group.members]:
+            return {"members": user_left}, {"$pull": {"members": user_left}}
 
+        if user.id in [user.ref.id for user in group.admins]:
             # If user is admin of the group but they is the only admin raise error
             if len(group.admins) == 1:
                 raise HTTPException(
@@ -264,17 +462,24 @@ async def left_group(
                         Ningún grupo puede quedarse sin administradores, agrega a un nuevo
                         administrador e intanta de nuevo
                     """).replace("\n", " ").strip()
-                ) from exc
+                )
 
-            del group.admins[i_user]
+            return (
+                {"admins": user_left, "admins.1": {"$exists": True}},
+                {"$pull": {"admins": user_left}}
+            )
 
-        except ValueError as exc:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Al parecer no estas dentro de este grupo, ninguna acción fue realizada"
-            ) from exc
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Al parecer no estas dentro de este grupo, ninguna acción fue realizada"
+        )
 
-    await group.replace()
+    await apply_membership_change(group, leave)
+    await write_membership_tombstones(group, [user.id])
+    await apply_membership_side_effects(
+        group, "memberLeft", [user.id], background_tasks, score_delta=-1
+    )
+    activity_log.record(group.id, "memberLeft", user.id)
 
     return {"msg": "ok"}
 
@@ -282,30 +487,55 @@ async def left_group(
 # Path operation for removing members or admins from a group
 @router.post("/{groupId}/remove-member/")
 async def remove_member_from_group(
-    group: Annotated[Group, Depends(fetch_group)],
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
     user: Annotated[User, Depends(get_current_user)],
-    userToRemove: Annotated[str, Body()]
+    userToRemove: Annotated[str, Body()],
+    background_tasks: BackgroundTasks
 ):
     check_user_is_group_admin(user, group)
 
-    try:
-        i_user = [str(user.ref.id) for user in group.members].index(userToRemove)
-        del group.members[i_user]
-
-    except ValueError as exc:
-        try:
-            i_user = [str(user.ref.id) for user in group.admins].index(userToRemove)
-            del group.admins[i_user]
+    def remove(group: Group) -> tuple[dict, dict]:
+        for roster in ("members", "admins"):
+            if userToRemove in [str(user.ref.id) for user in getattr(group, roster)]:
+                user_removed = user_ref(userToRemove)
+                return {roster: user_removed}, {"$pull": {roster: user_removed}}
 
-        except ValueError as exc:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=textwrap.dedent("""
-                    No se encontró ningún usuario entre los miembros o administradores del
-                    grupo que corresponda con el id proporcionado
-                """).replace("\n", " ").strip()
-            ) from exc
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=textwrap.dedent("""
+                No se encontró ningún usuario entre los miembros o administradores del
+                grupo que corresponda con el id proporcionado
+            """).replace("\n", " ").strip()
+        )
 
-    await group.replace()
+    await apply_membership_change(group, remove)
+    user_removed = PydanticObjectId(userToRemove)
+    await write_membership_tombstones(group, [user_removed])
+    await apply_membership_side_effects(
+        group, "memberRemoved", [user_removed], background_tasks, score_delta=-1
+    )
+    activity_log.record(group.id, "memberRemoved", user.id, user_removed)
 
     return {"msg": "ok"}
+
+
+# Audit trail of the group for moderation, newest first, paginated with the cursor of the
+# previous page
+@router.get("/{groupId}/activity/", response_model=schemas.ActivityResponse)
+async def get_group_activity(
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
+    user: Annotated[User, Depends(get_current_user)],
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 50
+):
+    check_user_is_group_admin(user, group)
+
+    # Fetches one extra entry to know if there is a next page
+    activity = await GroupActivity.find(
+        {"groupId": group.id, **keyset_query(cursor)}
+    ).sort([("createdAt", -1), ("_id", -1)]).limit(limit + 1).to_list()
+
+    return {
+        "activity": activity[:limit],
+        "nextCursor": encode_cursor(activity[limit - 1]) if len(activity) > limit else None
+    }
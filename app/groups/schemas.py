@@ -1,6 +1,10 @@
-from pydantic import BaseModel, model_serializer
+from typing import Any
+
+from pydantic import BaseModel, Field, model_serializer
 from pydantic.networks import HttpUrl, EmailStr
+from beanie import PydanticObjectId
 
+from . import enums
 from .models import Group
 from ..miscellaneous.pydantic_types import StrObjectId, ISOSerWrappedDt
 
@@ -14,6 +18,17 @@ class GroupPatch(BaseModel):
     externalLink: HttpUrl | None = None
 
 
+# ********* Projections *********
+
+class UserEmailProjection(BaseModel):
+    id: PydanticObjectId = Field(alias="_id")
+    email: EmailStr
+
+
+class GroupIdProjection(BaseModel):
+    id: PydanticObjectId = Field(alias="_id")
+
+
 # ********* Response schemas *********
 
 # post /groups/
@@ -23,6 +38,7 @@ class GroupUser(BaseModel):
     lastName: str
     email: EmailStr
     profileImage: str | None = None
+    lastActiveAt: ISOSerWrappedDt | None = None
 class GroupResponse(Group):
     admins: list[GroupUser]
     members: list[GroupUser]
@@ -42,3 +58,40 @@ class GroupResponse(Group):
 # get /{groupId}/members/
 class GroupUsersResponse(BaseModel):
     users: list[GroupUser]
+
+
+# post /{groupId}/import-members/
+class ImportRowResult(BaseModel):
+    row: int
+    email: str
+    status: enums.ImportRowStatusEnum
+class ImportMembersResponse(BaseModel):
+    added: int
+    invited: int
+    results: list[ImportRowResult]
+
+
+# get /groups/recommended/
+class RecommendedGroup(BaseModel):
+    groupId: StrObjectId
+    name: str
+    groupImage: str | None = None
+    groupColor: str | None = None
+    accessibility: enums.AccessibilityEnum
+    memberCount: int = 0
+    score: int
+class RecommendedGroupsResponse(BaseModel):
+    groups: list[RecommendedGroup]
+
+
+# get /groups/{groupId}/activity/
+class ActivityEntry(BaseModel):
+    id: StrObjectId
+    action: enums.ActivityActionEnum
+    actor: StrObjectId | None = None
+    target: StrObjectId | None = None
+    data: dict[str, Any] = {}
+    createdAt: ISOSerWrappedDt
+class ActivityResponse(BaseModel):
+    activity: list[ActivityEntry]
+    nextCursor: str | None = None
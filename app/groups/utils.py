@@ -1,7 +1,24 @@
-from fastapi import HTTPException, status
+from typing import AsyncIterator, BinaryIO, Callable, Iterator
+from datetime import datetime
+import codecs
+import csv
+import io
+import json
+import zlib
 
-from .models import Group
+from fastapi import HTTPException, status, BackgroundTasks
+from beanie import Link, PydanticObjectId
+from beanie.operators import In
+from bson import DBRef
+from pymongo import ReturnDocument
+
+from . import schemas
+from .models import Group, MembershipTombstone
+from .cache import group_cache
+from .recommendations import update_recommendation_scores
 from ..registration.models import User
+from ..miscellaneous.loader import DocumentLoader
+from ..realtime.broker import broker, group_channel, user_channel
 
 
 def check_user_is_group_admin(user: User, group: Group, custom_response: str | None = None):
@@ -13,3 +30,269 @@ def check_user_is_group_admin(user: User, group: Group, custom_response: str | N
                 if not custom_response else custom_response
             )
         )
+
+
+# Resolves a list of user links through the request's loader, so all the users requested in
+# the same loop iteration (e.g. admins and members) are fetched with a single query
+async def fetch_users(loader: DocumentLoader, links: list[Link[User]]) -> list[User]:
+    return await loader.load_many(User, [link.ref.id for link in links])
+
+
+# Update pipeline stage that derives the denormalized counters of a group from its lists
+GROUP_COUNTERS_STAGE = {
+    "$set": {
+        "memberCount": {"$size": {"$ifNull": ["$members", []]}},
+        "adminCount": {"$size": {"$ifNull": ["$admins", []]}},
+        "pendingRequestCount": {"$size": {"$ifNull": ["$joinRequests", []]}}
+    }
+}
+
+
+# Recomputes the denormalized counters of every group from its lists, returning how many groups
+# changed. Counters are kept up to date on each write, so this is only needed to repair drifted
+# documents or to backfill groups created before the counters existed. It's a single server-side
+# update of the whole collection, run on demand (see the ops routes in miscellaneous/router.py),
+# not on startup. Cached groups pick up the counters when their entries expire
+async def recompute_group_counters() -> int:
+    result = await Group.get_motor_collection().update_many({}, [GROUP_COUNTERS_STAGE])
+    return result.modified_count
+
+
+# Copies the current state of the group in the database into the given document. Needed after
+# sync()/update() when the lists of links matter, since beanie doesn't merge lists of links
+def refresh_group(group: Group, document: dict):
+    current = Group.model_validate(document)
+    for field in Group.model_fields:
+        setattr(group, field, getattr(current, field))
+
+
+MEMBERSHIP_MAX_RETRIES = 5 # Times a membership change is validated again if the group changed
+
+
+# Reference to a user as stored in the rosters of a group
+def user_ref(user_id) -> DBRef:
+    return DBRef(User.get_collection_name(), PydanticObjectId(user_id))
+
+
+# Applies a membership change as a single atomic update of the rosters ($addToSet/$pull), then
+# derives the counters from the lists on the server and leaves the group up to date with the
+# database. `change` validates the change against the group (raising the HTTP error if it doesn't
+# apply) and returns its (filter, update), where the filter states what was validated (e.g. that
+# the user still has a pending request). If the group changed meanwhile and no longer matches, it's
+# reloaded and the change is validated again.
+# Membership changes don't check nor renew the revision of the group: concurrent changes of the
+# rosters (e.g. two users joining at once) are all applied instead of failing, and they don't
+# make concurrent edits of the group info (which do check it) fail either
+async def apply_membership_change(group: Group, change: Callable[[Group], tuple[dict, dict]]):
+    collection = Group.get_motor_collection()
+    for _ in range(MEMBERSHIP_MAX_RETRIES):
+        condition, update = change(group)
+        result = await collection.update_one(
+            {"_id": group.id, **condition},
+            {**update, "$set": {"updatedAt": datetime.utcnow()}}
+        )
+
+        if result.matched_count:
+            document = await collection.find_one_and_update(
+                {"_id": group.id}, [GROUP_COUNTERS_STAGE], return_document=ReturnDocument.AFTER
+            )
+        else:
+            document = await collection.find_one({"_id": group.id})
+
+        if not document:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="El grupo solicitado no existe"
+            )
+        refresh_group(group, document)
+
+        if result.matched_count:
+            await group_cache.invalidate_everywhere(str(group.id))
+            return
+
+    raise HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="El grupo está recibiendo demasiados cambios, intenta de nuevo en unos momentos"
+    )
+
+
+# Publishes a membership change to the group's admins and to the affected user, along with the
+# updated counters so clients can refresh their badges without refetching the group
+async def publish_membership_event(
+    group: Group, event_type: str, user_id, notify_group: bool = True
+):
+    data = {
+        "groupId": str(group.id),
+        "userId": str(user_id),
+        "memberCount": group.memberCount,
+        "adminCount": group.adminCount,
+        "pendingRequestCount": group.pendingRequestCount
+    }
+    if notify_group:
+        await broker.publish(group_channel(group.id), event_type, data)
+    await broker.publish(user_channel(user_id), event_type, data)
+
+
+# Side effects of an applied membership change of the given users, shared by the routes that
+# change the rosters: the event is published for each user (see publish_membership_event) and, if
+# the users joined or left the members (score_delta), the recommendation scores of the group are
+# updated after responding. notify_group=False skips the events of the group's channel, for
+# callers that publish a single summary there instead
+async def apply_membership_side_effects(
+    group: Group,
+    event_type: str,
+    user_ids: list,
+    background_tasks: BackgroundTasks,
+    score_delta: int = 0,
+    notify_group: bool = True
+):
+    for user_id in user_ids:
+        await publish_membership_event(group, event_type, user_id, notify_group)
+
+    if score_delta and user_ids:
+        background_tasks.add_task(update_recommendation_scores, group, user_ids, score_delta)
+
+
+# Records that the users are no longer admins or members of the group, for delta sync
+async def write_membership_tombstones(group: Group, user_ids: list):
+    if user_ids:
+        await MembershipTombstone.insert_many([
+            MembershipTombstone(userId=user_id, groupId=group.id) for user_id in user_ids
+        ])
+
+
+ROSTER_EXPORT_FIELDS = [
+    "id", "firstName", "lastName", "email", "userType", "division", "academicLevel",
+    "degreeName"
+]
+
+ROSTER_EXPORT_BATCH_SIZE = 500 # Users fetched per $in query (and rows per chunk sent)
+
+
+# Streams the given users as NDJSON or CSV rows, reading them straight from a cursor (with only
+# the exported fields projected) instead of materializing User documents, so memory use doesn't
+# depend on the size of the roster
+async def stream_roster(links: list[Link[User]], export_format: str) -> AsyncIterator[str]:
+    collection = User.get_motor_collection()
+    user_ids = [link.ref.id for link in links]
+    projection = {field: 1 for field in ROSTER_EXPORT_FIELDS if field != "id"}
+
+    if export_format == "csv":
+        yield ",".join(ROSTER_EXPORT_FIELDS) + "\r\n"
+
+    for i in range(0, len(user_ids), ROSTER_EXPORT_BATCH_SIZE):
+        cursor = collection.find(
+            {"_id": {"$in": user_ids[i:i + ROSTER_EXPORT_BATCH_SIZE]}}, projection
+        ).batch_size(ROSTER_EXPORT_BATCH_SIZE)
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        async for document in cursor:
+            row = {field: document.get(field) for field in ROSTER_EXPORT_FIELDS if field != "id"}
+            row = {"id": str(document["_id"]), **row}
+
+            if export_format == "csv":
+                writer.writerow(["" if value is None else value for value in row.values()])
+            else:
+                buffer.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+        yield buffer.getvalue()
+
+
+async def gzip_stream(chunks: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31) # 31 = gzip container
+    async for chunk in chunks:
+        if compressed := compressor.compress(chunk.encode()):
+            yield compressed
+    yield compressor.flush()
+
+
+IMPORT_BATCH_SIZE = 500 # Emails resolved (and users added) per query
+
+IMPORT_MAX_ROWS = 10000
+
+
+# Yields the (row number, email) pairs of a CSV file, reading it row by row. The email is taken
+# from the "email" column if the file has a header, otherwise from the first column. Files that
+# aren't UTF-8 text or have more than IMPORT_MAX_ROWS rows are rejected
+def read_csv_emails(file: BinaryIO) -> Iterator[tuple[int, str]]:
+    email_column = 0
+    reader = csv.reader(codecs.iterdecode(file, "utf-8-sig"))
+    try:
+        for row_number, row in enumerate(reader, start=1):
+            if row_number > IMPORT_MAX_ROWS:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"El archivo no puede tener más de {IMPORT_MAX_ROWS} filas"
+                )
+
+            if row_number == 1:
+                header = [cell.strip().lower() for cell in row]
+                if "email" in header:
+                    email_column = header.index("email")
+                    continue
+
+            if not row:
+                continue
+
+            yield row_number, row[email_column].strip() if len(row) > email_column else ""
+
+    except (UnicodeDecodeError, csv.Error) as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="El archivo debe ser un CSV con codificación UTF-8"
+        ) from exc
+
+
+# Adds as members of the group the users matching a batch of emails, resolving them with a single
+# query and adding them with a single atomic update (see apply_membership_change), which also
+# moves the ones with a pending join request. Returns the status of each row and the ids of the
+# users added, and leaves the group up to date with the database
+async def add_members_by_email(
+    group: Group, rows: list[tuple[int, str]]
+) -> tuple[list[dict], list[PydanticObjectId]]:
+    # pylint: disable=E1101
+    users = {
+        user.email: user.id
+        for user in await User.find(
+            In(User.email, [email for _, email in rows]),
+            projection_model=schemas.UserEmailProjection
+        ).to_list()
+    }
+
+    new_members = []
+
+    # The filter checks that none of the users to add became an admin or member meanwhile, so
+    # the ones reported as added weren't in the group already
+    def add(group: Group) -> tuple[dict, dict]:
+        nonlocal new_members
+        in_group = {link.ref.id for link in group.admins + group.members}
+        new_members = [user_id for user_id in users.values() if user_id not in in_group]
+
+        new_members_refs = [user_ref(user_id) for user_id in new_members]
+        return (
+            {"admins": {"$nin": new_members_refs}, "members": {"$nin": new_members_refs}},
+            {
+                "$addToSet": {"members": {"$each": new_members_refs}},
+                "$pull": {"joinRequests": {"$in": new_members_refs}}
+            }
+        )
+
+    in_group = {link.ref.id for link in group.admins + group.members}
+    if any(user_id not in in_group for user_id in users.values()):
+        await apply_membership_change(group, add)
+
+    added = set(new_members)
+    results = [
+        {
+            "row": row_number,
+            "email": email,
+            "status": (
+                "invited" if email not in users else
+                "added" if users[email] in added else
+                "alreadyInGroup"
+            )
+        }
+        for row_number, email in rows
+    ]
+    return results, new_members
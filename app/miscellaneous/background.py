@@ -0,0 +1,79 @@
+# Base classes of the background tasks each worker runs while the application is up (started and
+# stopped in the lifespan of the app, see main.py).
+#
+# BackgroundTask runs _run in a task from start() until stop() cancels it, for tasks that wait on
+# something else (e.g. the events of a subscription) and have nothing to lose if interrupted.
+#
+# PeriodicTask runs run_once every `interval` seconds (or earlier, when wake() is called, e.g.
+# because a buffer filled up), logging the failed runs instead of stopping. Its task isn't
+# cancelled on stop, it's woken up and awaited, so a run in progress is never interrupted (which
+# for a flusher would lose the batch it took from its buffer). Flushers set run_on_stop, so what
+# is left in memory is written after the last periodic run.
+
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundTask:
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self):
+        raise NotImplementedError
+
+
+class PeriodicTask(BackgroundTask):
+    run_on_start = False # Runs as soon as it starts, instead of after the first interval
+    run_on_stop = False # Runs once more after the last periodic run, when stopping
+    failure_message = "Periodic task failed" # Logged (with the exception) when a run fails
+
+    def __init__(self, interval: float):
+        super().__init__()
+        self.interval = interval
+        self._wake_up = asyncio.Event()
+        self._stopping = False
+
+    async def run_once(self):
+        raise NotImplementedError
+
+    # Makes the next run start right away
+    def wake(self):
+        self._wake_up.set()
+
+    async def stop(self):
+        self._stopping = True
+        self._wake_up.set()
+        if self._task:
+            await self._task
+        if self.run_on_stop:
+            await self._run_safely()
+
+    async def _run_safely(self):
+        try:
+            await self.run_once()
+        except Exception: # pylint: disable=W0718
+            logger.exception(self.failure_message)
+
+    async def _run(self):
+        if self.run_on_start:
+            await self._run_safely()
+
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake_up.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake_up.clear()
+
+            if not self._stopping:
+                await self._run_safely()
@@ -0,0 +1,159 @@
+# Negotiated compression of responses.
+#
+# Picks brotli or gzip from the Accept-Encoding header of the request (brotli only when the
+# optional brotli package is installed) and compresses text responses (JSON, CSV, NDJSON...)
+# whose body reaches COMPRESSION_MIN_SIZE bytes. Smaller bodies are sent as they are, since
+# compressing them saves less than it costs.
+#
+# Bodies are compressed chunk by chunk as the application sends them, so streamed responses
+# keep streaming and aren't buffered. Chunks of COMPRESSION_OFFLOAD_SIZE bytes or more are
+# compressed in the threadpool (zlib and brotli release the GIL) so big listings don't stall
+# the event loop. Server-sent events and responses already encoded by the application (e.g. the
+# gzipped roster exports) are left untouched.
+
+from typing import Callable
+import zlib
+
+from decouple import config
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import brotli
+except ImportError: # brotli is optional, gzip is used when it's not installed
+    brotli = None
+
+
+COMPRESSION_MIN_SIZE = config("COMPRESSION_MIN_SIZE", default=1024, cast=int) # Bytes
+COMPRESSION_OFFLOAD_SIZE = config(
+    "COMPRESSION_OFFLOAD_SIZE", default=256 * 1024, cast=int
+) # Bytes
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5 # Brotli's default (11) is too slow for compressing responses on the fly
+
+COMPRESSIBLE_TYPES = (
+    "text/", "application/json", "application/x-ndjson", "application/javascript",
+    "application/xml"
+)
+
+
+# Returns the preferred encoding among the supported ones accepted by the client, or None
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        accepted[coding.strip().lower()] = quality
+
+    supported = ["br", "gzip"] if brotli else ["gzip"]
+    for coding in supported:
+        if accepted.get(coding, accepted.get("*", 0)) > 0:
+            return coding
+    return None
+
+
+# Returns the (compress, finish) functions of an incremental compressor for the encoding
+def get_compressor(encoding: str) -> tuple[Callable[[bytes], bytes], Callable[[], bytes]]:
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+
+def is_compressible(headers: list[tuple[bytes, bytes]]) -> bool:
+    content_type = ""
+    for header, value in headers:
+        if header == b"content-encoding":
+            return False
+        if header == b"content-type":
+            content_type = value.decode("latin-1").lower()
+
+    return (
+        content_type.startswith(COMPRESSIBLE_TYPES) and
+        not content_type.startswith("text/event-stream")
+    )
+
+
+# Pure ASGI middleware, like DBMetricsMiddleware, so streamed responses are compressed as they
+# are produced
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        accept_encoding = ""
+        for header, value in scope["headers"]:
+            if header == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+
+        if not (encoding := negotiate_encoding(accept_encoding)):
+            return await self.app(scope, receive, send)
+
+        start_message = None
+        compress = finish = None
+        passthrough = False
+
+        async def compress_chunk(body: bytes) -> bytes:
+            if len(body) >= COMPRESSION_OFFLOAD_SIZE:
+                return await run_in_threadpool(compress, body)
+            return compress(body)
+
+        async def send_wrapper(message):
+            nonlocal start_message, compress, finish, passthrough
+
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                if not is_compressible(headers):
+                    passthrough = True
+                    return await send(message)
+
+                headers.append((b"vary", b"Accept-Encoding"))
+                message["headers"] = headers
+                # Holds the start of the response until the size of the body is known
+                start_message = message
+                return None
+
+            if passthrough or message["type"] != "http.response.body":
+                return await send(message)
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if start_message is not None:
+                headers = start_message["headers"]
+
+                # Sends small bodies (sent in a single message) as they are
+                if not more_body and len(body) < COMPRESSION_MIN_SIZE:
+                    passthrough = True
+                    await send(start_message)
+                    return await send(message)
+
+                compress, finish = get_compressor(encoding)
+                start_message["headers"] = [
+                    (header, value) for header, value in headers if header != b"content-length"
+                ] + [(b"content-encoding", encoding.encode())]
+                await send(start_message)
+                start_message = None
+
+            compressed = await compress_chunk(body) if body else b""
+            if not more_body:
+                compressed += finish()
+
+            # Skips empty chunks (the compressor may not output anything yet), except the last one
+            if compressed or not more_body:
+                await send({
+                    "type": "http.response.body", "body": compressed, "more_body": more_body
+                })
+            return None
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,118 @@
+# Per request accounting of the commands sent to mongo.
+#
+# A pymongo command listener records the number and duration of every command on the stats
+# object of the request being handled (tracked through a context variable, which motor copies
+# into the threads where it runs pymongo operations), and a middleware reports them to the
+# client through a Server-Timing header.
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import Counter
+import re
+import threading
+import time
+
+from pymongo import monitoring
+
+
+class DBStats:
+    def __init__(self, record_commands: bool = False):
+        self.count = 0
+        self.duration = 0.0 # Milliseconds
+        self.commands = Counter()
+        # Full command documents, only kept when asked for (e.g. by the query plan tests)
+        self.recorded: list[tuple[str, dict]] | None = [] if record_commands else None
+        self._lock = threading.Lock()
+
+    def record(self, command_name: str, duration_micros: int):
+        with self._lock:
+            self.count += 1
+            self.duration += duration_micros / 1000
+            self.commands[command_name] += 1
+
+    def record_command(self, database_name: str, command: dict):
+        with self._lock:
+            self.recorded.append((database_name, dict(command)))
+
+
+_current_stats: ContextVar[DBStats | None] = ContextVar("db_stats", default=None)
+
+
+class CommandStatsListener(monitoring.CommandListener):
+    def started(self, event):
+        if (stats := _current_stats.get()) and stats.recorded is not None:
+            stats.record_command(event.database_name, event.command)
+
+    def succeeded(self, event):
+        if stats := _current_stats.get():
+            stats.record(event.command_name, event.duration_micros)
+
+    def failed(self, event):
+        if stats := _current_stats.get():
+            stats.record(event.command_name, event.duration_micros)
+
+
+command_stats_listener = CommandStatsListener()
+
+
+# Pure ASGI middleware (instead of BaseHTTPMiddleware) so the context variable is set in the
+# same context the route handler runs in, and streamed responses aren't buffered.
+# For streamed responses the header is sent before the body, so it only accounts for the
+# commands issued until the response started
+class DBMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = DBStats()
+        token = _current_stats.set(stats)
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                total = (time.perf_counter() - start) * 1000
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", (
+                    f'db;dur={stats.duration:.2f};desc="{stats.count} commands", '
+                    f'app;dur={total:.2f}'
+                ).encode()))
+                message["headers"] = headers
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_stats.reset(token)
+
+
+# ********* Test helpers *********
+
+# Counts the commands issued inside the block when the code runs in the current context (e.g.
+# awaiting utils or dependencies directly). With record_commands the command documents are kept
+# as well
+@contextmanager
+def track_queries(record_commands: bool = False):
+    stats = DBStats(record_commands)
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+def get_query_count(response) -> int:
+    match = re.search(r'db;dur=[\d.]+;desc="(\d+) commands"', response.headers["server-timing"])
+    return int(match.group(1))
+
+
+# Fails if handling the request took more commands than the budget, e.g.
+#   assert_query_budget(client.post(f"/groups/{group_id}/join/", headers=auth), 3)
+def assert_query_budget(response, max_queries: int):
+    count = get_query_count(response)
+    assert count <= max_queries, (
+        f"{response.request.method} {response.request.url.path} issued {count} database "
+        f"commands, the budget is {max_queries}"
+    )
@@ -1,11 +1,16 @@
 from typing import Annotated
+import secrets
 from decouple import config
 
-from fastapi import Depends, HTTPException, status, UploadFile
+from fastapi import Depends, HTTPException, status, UploadFile, Request, Header
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
+from bson.errors import InvalidId
 
+from .loader import DocumentLoader
 from ..registration.models import User
+from ..registration.revocation import revocation_list
+from ..registration.presence import presence_tracker
 
 
 DB_URL = config('DB_URL', cast=str)
@@ -14,22 +19,57 @@ DB_NAME = config('DB_NAME', cast=str)
 SECRET_KEY = config('SECRET_KEY', cast=str)
 ALGORITHM = config('ALGORITHM', cast=str)
 
+OPS_TOKEN = config('OPS_TOKEN', default="", cast=str)
+
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/signin/")
 
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
+# Returns the loader (identity map) of the current request, shared by all its dependencies.
+# Dependencies that don't block are async, so they run in the event loop instead of the threadpool
+async def get_loader(request: Request) -> DocumentLoader:
+    if not hasattr(request.state, "loader"):
+        request.state.loader = DocumentLoader()
+    return request.state.loader
+
+
+# Decodes the access token, rejecting it if it was revoked (checked in memory, see
+# registration/revocation.py)
+async def get_token_payload(token: Annotated[str, Depends(oauth2_scheme)]) -> dict:
     payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    user_id = payload.get("sub")
-    if (
-        user := await User.get(user_id)
-    ) is None:
+
+    if revocation_list.is_revoked(payload):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            headers={"WWW-Authenticate": "Bearer"},
+            detail="Token de acceso invalido"
+        )
+
+    return payload
+
+
+async def get_current_user_id(payload: Annotated[dict, Depends(get_token_payload)]) -> str:
+    return payload.get("sub")
+
+
+async def get_current_user(
+    user_id: Annotated[str, Depends(get_current_user_id)],
+    loader: Annotated[DocumentLoader, Depends(get_loader)]
+):
+    try:
+        user = await loader.load(User, user_id)
+    except InvalidId:
+        user = None
+
+    if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             headers={"WWW-Authenticate": "Bearer"},
             detail="Token de acceso invalido"
         )
 
+    presence_tracker.record(user.id)
+
     return user
 
 
@@ -49,3 +89,10 @@ def validate_upload_file(uploadFile: UploadFile):
         )
 
     return uploadFile
+
+
+# Guards the operational endpoints (metrics, diagnostics). They don't exist unless an OPS_TOKEN is
+# configured, and it must be sent in the X-Ops-Token header
+def verify_ops_token(x_ops_token: Annotated[str | None, Header()] = None):
+    if not OPS_TOKEN or not secrets.compare_digest(x_ops_token or "", OPS_TOKEN):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
@@ -0,0 +1,75 @@
+# Request scoped identity map and batched loader for beanie documents.
+#
+# Within a request every document is fetched at most once (later loads of the same id get the
+# same instance), and the loads of the same model issued in the same event loop iteration (e.g.
+# dependencies or helpers run with asyncio.gather) are batched into a single $in query.
+
+import asyncio
+from collections import defaultdict
+from typing import TypeVar
+
+from beanie import Document, PydanticObjectId
+from beanie.operators import In
+
+
+DocumentT = TypeVar("DocumentT", bound=Document)
+
+
+class DocumentLoader:
+    def __init__(self):
+        self._futures: dict[tuple[type[Document], PydanticObjectId], asyncio.Future] = {}
+        self._pending: dict[type[Document], list[PydanticObjectId]] = defaultdict(list)
+        # The event loop only keeps weak references to tasks, so the running dispatches are kept
+        # here until they finish
+        self._tasks: set[asyncio.Task] = set()
+
+    async def load(self, model: type[DocumentT], document_id) -> DocumentT | None:
+        document_id = PydanticObjectId(document_id)
+        key = (model, document_id)
+
+        if key not in self._futures:
+            self._futures[key] = asyncio.get_running_loop().create_future()
+
+            # The first pending load of a model schedules the query, which is sent once the
+            # current loop iteration finishes, so it includes every load requested meanwhile
+            if not self._pending[model]:
+                asyncio.get_running_loop().call_soon(self._schedule_dispatch, model)
+            self._pending[model].append(document_id)
+
+        return await asyncio.shield(self._futures[key])
+
+    # Returns the documents in the order of the given ids, skipping the ones that don't exist
+    async def load_many(self, model: type[DocumentT], document_ids) -> list[DocumentT]:
+        documents = await asyncio.gather(
+            *(self.load(model, document_id) for document_id in document_ids)
+        )
+        return [document for document in documents if document is not None]
+
+    # Adds to the identity map a document fetched by other means
+    def prime(self, document: Document):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(document)
+        self._futures[(type(document), document.id)] = future
+
+    def _schedule_dispatch(self, model: type[Document]):
+        task = asyncio.get_running_loop().create_task(self._dispatch(model))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, model: type[Document]):
+        document_ids = self._pending.pop(model)
+
+        try:
+            documents = {
+                document.id: document
+                for document in await model.find(In(model.id, document_ids)).to_list()
+            }
+        except Exception as exc: # pylint: disable=W0718
+            for document_id in document_ids:
+                self._futures[(model, document_id)].set_exception(exc)
+                # A failed load may be retried
+                del self._futures[(model, document_id)]
+            return
+
+        for document_id in document_ids:
+            self._futures[(model, document_id)].set_result(documents.get(document_id))
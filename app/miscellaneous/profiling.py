@@ -0,0 +1,127 @@
+# On demand profiling of requests.
+#
+# A request is profiled (with cProfile) when it carries the X-Profile header with the value of
+# PROFILING_TOKEN, or when it's picked by sampling (PROFILING_SAMPLE_RATE, from 0 to 1). The
+# stats are written as .prof files (pstats format) to PROFILING_SPOOL_DIR, named after the
+# route handler and the time the request took, and only the newest PROFILING_SPOOL_SIZE files
+# are kept. They can be listed and downloaded through /metrics/profiles/ and read with pstats or
+# turned into a flamegraph with tools like snakeviz or flameprof.
+#
+# The middleware is only installed when profiling is configured, so it costs nothing when off.
+#
+# cProfile profiles the whole thread, and requests share the event loop thread: the profile of
+# a request also includes whatever other requests ran while it was awaiting. So a single request
+# is profiled at a time, and profiles are most readable when taken on a quiet worker.
+
+from datetime import datetime
+import cProfile
+import os
+import random
+import re
+import secrets
+import tempfile
+import time
+
+from decouple import config
+from starlette.concurrency import run_in_threadpool
+
+
+PROFILING_TOKEN = config("PROFILING_TOKEN", default="", cast=str)
+PROFILING_SAMPLE_RATE = config("PROFILING_SAMPLE_RATE", default=0, cast=float)
+PROFILING_SPOOL_DIR = config(
+    "PROFILING_SPOOL_DIR", default=os.path.join(tempfile.gettempdir(), "ug-groups-profiles"),
+    cast=str
+)
+PROFILING_SPOOL_SIZE = config("PROFILING_SPOOL_SIZE", default=200, cast=int) # Files
+PROFILING_MAX_DURATION = config("PROFILING_MAX_DURATION", default=30, cast=float) # Seconds
+
+PROFILING_ENABLED = bool(PROFILING_TOKEN or PROFILING_SAMPLE_RATE > 0)
+
+PROFILE_FILE_EXTENSION = ".prof"
+
+
+def list_profiles() -> list[str]:
+    if not os.path.isdir(PROFILING_SPOOL_DIR):
+        return []
+    return sorted(
+        name for name in os.listdir(PROFILING_SPOOL_DIR) if name.endswith(PROFILE_FILE_EXTENSION)
+    )
+
+
+# Writes the profile and deletes the oldest ones over the spool size. Names start with the
+# time the request was received, so sorting them sorts them by age
+def save_profile(profiler: cProfile.Profile, name: str):
+    os.makedirs(PROFILING_SPOOL_DIR, exist_ok=True)
+    profiler.dump_stats(os.path.join(PROFILING_SPOOL_DIR, name))
+
+    for old_name in list_profiles()[:-PROFILING_SPOOL_SIZE]:
+        try:
+            os.remove(os.path.join(PROFILING_SPOOL_DIR, old_name))
+        except FileNotFoundError:
+            pass
+
+
+# Pure ASGI middleware, like DBMetricsMiddleware, so the profiler is enabled in the same task the
+# route handler runs in and streamed responses are profiled until their last chunk (up to
+# PROFILING_MAX_DURATION)
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self._profiling = False
+
+    def _should_profile(self, scope) -> bool:
+        if scope["type"] != "http" or self._profiling:
+            return False
+
+        if PROFILING_TOKEN:
+            for header, value in scope["headers"]:
+                if header == b"x-profile":
+                    return secrets.compare_digest(value.decode("latin-1"), PROFILING_TOKEN)
+
+        return random.random() < PROFILING_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if not self._should_profile(scope):
+            return await self.app(scope, receive, send)
+
+        self._profiling = True
+        received_at = datetime.utcnow()
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        finished = False
+
+        async def finish():
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            profiler.disable()
+            self._profiling = False
+
+            elapsed = (time.perf_counter() - start) * 1000
+            endpoint = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            name = re.sub(r"[^\w.-]", "_", (
+                f"{received_at:%Y%m%dT%H%M%S%f}-{scope['method']}-{endpoint}-{elapsed:.0f}ms"
+            )) + PROFILE_FILE_EXTENSION
+            await run_in_threadpool(save_profile, profiler, name)
+
+        # Server-sent events never end, so their profile stops when the stream starts. Any other
+        # response stops being profiled after PROFILING_MAX_DURATION, so a long download doesn't
+        # keep the whole worker profiled (and every other profile blocked)
+        async def send_wrapper(message):
+            if not finished and (
+                time.perf_counter() - start > PROFILING_MAX_DURATION or (
+                    message["type"] == "http.response.start" and any(
+                        header == b"content-type" and value.startswith(b"text/event-stream")
+                        for header, value in message.get("headers", [])
+                    )
+                )
+            ):
+                await finish()
+            await send(message)
+
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            await finish()
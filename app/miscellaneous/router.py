@@ -0,0 +1,48 @@
+import os
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import FileResponse
+
+from .dependencies import verify_ops_token
+from .profiling import PROFILING_SPOOL_DIR, list_profiles
+from ..groups.cache import group_cache
+from ..groups.utils import recompute_group_counters
+from ..registration.revocation import revocation_list
+
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=["metrics"],
+    dependencies=[Depends(verify_ops_token)],
+    include_in_schema=False
+)
+
+
+@router.get("/group-cache/")
+async def get_group_cache_metrics():
+    return group_cache.stats()
+
+
+# Repairs the counters of the groups that drifted (or don't exist yet in old documents). A one-off
+# operation run after deploying, instead of on the startup of every worker
+@router.post("/group-counters/recompute/")
+async def recompute_groups_counters():
+    return {"modified": await recompute_group_counters()}
+
+
+@router.get("/token-revocations/")
+async def get_token_revocations_metrics():
+    return revocation_list.stats()
+
+
+@router.get("/profiles/")
+async def get_profiles():
+    return {"profiles": list_profiles()}
+
+
+@router.get("/profiles/{name}")
+async def download_profile(name: str):
+    if name not in list_profiles():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+
+    return FileResponse(os.path.join(PROFILING_SPOOL_DIR, name), filename=name)
@@ -1,6 +1,46 @@
+from datetime import datetime
+import base64
 import os
 
+from fastapi import HTTPException, status
+from beanie import PydanticObjectId
+from bson.errors import InvalidId
+
+
 def get_media_root():
     return os.path.abspath(
         os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, "media")
     )
+
+
+# Cursors for keyset pagination (newest first) over documents with a createdAt field. They are
+# opaque to clients, and encode the (createdAt, _id) keyset of the last document of a page
+def encode_cursor(document) -> str:
+    raw = f"{document.createdAt.isoformat()}|{document.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, PydanticObjectId]:
+    try:
+        created_at, document_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), PydanticObjectId(document_id)
+
+    except (ValueError, InvalidId) as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="El cursor proporcionado no es valido"
+        ) from exc
+
+
+# Filter for the documents after the cursor, to be used sorting by (createdAt, _id) descending.
+# The $or alone can't bound the scan of the (..., createdAt, _id) indexes, the top level range on
+# createdAt does, so pages after the first start right at the cursor instead of at the newest entry
+def keyset_query(cursor: str | None) -> dict:
+    if not cursor:
+        return {}
+
+    created_at, document_id = decode_cursor(cursor)
+    return {"createdAt": {"$lte": created_at}, "$or": [
+        {"createdAt": {"$lt": created_at}},
+        {"createdAt": created_at, "_id": {"$lt": document_id}}
+    ]}
@@ -0,0 +1,29 @@
+from datetime import datetime
+
+from pydantic import Field
+from pymongo import IndexModel, DESCENDING
+from beanie import Document, before_event, Replace, Link, PydanticObjectId
+
+from ..registration.models import User
+
+
+class Post(Document):
+    groupId: PydanticObjectId
+    author: Link[User]
+    content: str
+    multimedia: list[str] = []
+    createdAt: datetime = Field(default_factory=datetime.utcnow)
+    updatedAt: datetime = Field(default_factory=datetime.utcnow)
+
+    @before_event(Replace)
+    def update_updatedAt_field(self):
+        self.updatedAt = datetime.utcnow()
+
+    class Settings:
+        name = "posts"
+        # Feeds are read newest first, paginating with (createdAt, _id) as keyset. For the
+        # feed across several groups, mongo merges the per group index ranges already sorted
+        # (SORT_MERGE) instead of sorting every post of those groups in memory
+        indexes = [
+            IndexModel([("groupId", 1), ("createdAt", DESCENDING), ("_id", DESCENDING)])
+        ]
@@ -0,0 +1,83 @@
+from typing import Annotated
+
+from fastapi import APIRouter, HTTPException, status, Depends, Query
+from beanie import PydanticObjectId
+from beanie.operators import In
+
+from . import schemas
+from .models import Post
+from .utils import check_user_can_publish, check_user_can_read_posts, get_feed_page
+from ..groups.models import Group
+from ..groups.schemas import GroupIdProjection
+from ..groups.dependencies import fetch_group_and_prefetch_user
+from ..registration.models import User
+from ..uploads.models import UploadSession
+from ..miscellaneous.dependencies import get_current_user, get_loader
+from ..miscellaneous.loader import DocumentLoader
+
+
+FEED_PAGE_SIZE = 20
+FEED_MAX_PAGE_SIZE = 100
+
+router = APIRouter(tags=["posts"])
+
+
+@router.post("/groups/{groupId}/posts/", response_model=schemas.PostResponse)
+async def publish_post(
+    postCreate: schemas.PostCreate,
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
+    user: Annotated[User, Depends(get_current_user)]
+):
+    check_user_can_publish(user, group)
+
+    # Attaches the multimedia files the user uploaded beforehand
+    uploads = await UploadSession.find(
+        In(UploadSession.id, [PydanticObjectId(upload) for upload in postCreate.uploads]),
+        UploadSession.owner == user.id,
+        UploadSession.mediaPath != None # pylint: disable=C0121
+    ).to_list()
+    if len(uploads) != len(set(postCreate.uploads)):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Algunos de los archivos adjuntos no existen o no se han terminado de subir"
+        )
+
+    post = await Post(
+        groupId=group.id,
+        author=user,
+        content=postCreate.content,
+        multimedia=[upload.mediaPath for upload in uploads]
+    ).insert()
+    post.author = user
+
+    return post
+
+
+@router.get("/groups/{groupId}/posts/", response_model=schemas.FeedResponse)
+async def get_group_feed(
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
+    user: Annotated[User, Depends(get_current_user)],
+    loader: Annotated[DocumentLoader, Depends(get_loader)],
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=FEED_MAX_PAGE_SIZE)] = FEED_PAGE_SIZE
+):
+    check_user_can_read_posts(user, group)
+
+    return await get_feed_page([group.id], cursor, limit, loader)
+
+
+# Feed with the posts of all the groups the user belongs to (as admin or member)
+@router.get("/feed/", response_model=schemas.FeedResponse)
+async def get_my_feed(
+    user: Annotated[User, Depends(get_current_user)],
+    loader: Annotated[DocumentLoader, Depends(get_loader)],
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=FEED_MAX_PAGE_SIZE)] = FEED_PAGE_SIZE
+):
+    # pylint: disable=E1101
+    groups = await Group.find(
+        {"$or": [{"admins.$id": user.id}, {"members.$id": user.id}]},
+        projection_model=GroupIdProjection
+    ).to_list()
+
+    return await get_feed_page([group.id for group in groups], cursor, limit, loader)
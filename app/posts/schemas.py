@@ -0,0 +1,30 @@
+from pydantic import BaseModel
+
+from ..groups.schemas import GroupUser
+from ..miscellaneous.pydantic_types import StrObjectId, ISOSerWrappedDt
+
+
+# ********* Request schemas *********
+
+# post /groups/{groupId}/posts/
+class PostCreate(BaseModel):
+    content: str
+    uploads: list[str] = [] # Ids of finalized upload sessions to attach as multimedia
+
+
+# ********* Response schemas *********
+
+class PostResponse(BaseModel):
+    id: StrObjectId
+    groupId: StrObjectId
+    author: GroupUser
+    content: str
+    multimedia: list[str] = []
+    createdAt: ISOSerWrappedDt
+
+
+# get /groups/{groupId}/posts/
+# get /feed/
+class FeedResponse(BaseModel):
+    posts: list[PostResponse]
+    nextCursor: str | None = None
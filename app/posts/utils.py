@@ -0,0 +1,59 @@
+import asyncio
+
+from fastapi import HTTPException, status
+
+from .models import Post
+from ..groups.models import Group
+from ..registration.models import User
+from ..miscellaneous.loader import DocumentLoader
+from ..miscellaneous.utils import encode_cursor, keyset_query
+
+
+def check_user_can_publish(user: User, group: Group):
+    admins = [admin.ref.id for admin in group.admins]
+    members = [member.ref.id for member in group.members]
+
+    if (
+        (group.whoCanPublish == "onlyAdmins" and user.id not in admins) or
+        (group.whoCanPublish == "members" and user.id not in admins + members)
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="No tienes permiso para publicar en este grupo"
+        )
+
+
+def check_user_can_read_posts(user: User, group: Group):
+    if group.accessibility == "public":
+        return
+
+    if user.id not in [user.ref.id for user in group.admins + group.members]:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Solo los miembros de este grupo pueden ver sus publicaciones"
+        )
+
+
+# Returns a page of the posts of the given groups, newest first, starting after the cursor (if
+# any) and the cursor for the next page. Uses keyset pagination so every page costs the same
+# no matter how deep into the feed the client is
+async def get_feed_page(
+    group_ids: list, cursor: str | None, limit: int, loader: DocumentLoader
+):
+    query = {"groupId": {"$in": group_ids}, **keyset_query(cursor)}
+
+    # Fetches one extra post to know if there is a next page
+    posts = await Post.find(query).sort(
+        [("createdAt", -1), ("_id", -1)]
+    ).limit(limit + 1).to_list()
+
+    next_cursor = encode_cursor(posts[limit - 1]) if len(posts) > limit else None
+    posts = posts[:limit]
+
+    # Resolves the authors of the whole page with a single query (the current user, already in
+    # the request's identity map, isn't fetched again)
+    authors = await asyncio.gather(*(loader.load(User, post.author.ref.id) for post in posts))
+    for post, author in zip(posts, authors):
+        post.author = author
+
+    return {"posts": [post for post in posts if post.author], "nextCursor": next_cursor}
@@ -0,0 +1,140 @@
+# In-process publish/subscribe used to push events to clients (through server-sent events).
+#
+# Route handlers publish events to a channel (one per group and one per user) and every
+# subscriber of that channel gets its own bounded queue. Fanning out is done through a backend:
+# the in-memory backend delivers straight to local subscribers (enough for a single worker),
+# while the mongo backend stores events in a collection and every worker delivers them to its
+# local subscribers through a change stream (needed when running multiple workers).
+
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any
+
+from decouple import config
+from pymongo.errors import PyMongoError
+
+from .models import RealtimeEvent
+from ..miscellaneous.background import BackgroundTask
+
+
+REALTIME_BACKEND = config("REALTIME_BACKEND", default="memory", cast=str)
+
+SUBSCRIBER_QUEUE_SIZE = 100 # Max events buffered for a subscriber that isn't reading
+
+logger = logging.getLogger(__name__)
+
+
+def group_channel(group_id) -> str:
+    return f"group:{group_id}"
+
+
+def user_channel(user_id) -> str:
+    return f"user:{user_id}"
+
+
+class Subscription:
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.queue: asyncio.Queue[dict[str, Any]] = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        # Set when the subscriber fell behind and events were dropped, so the client knows it
+        # has to resync its state
+        self.lagged = False
+
+    def put(self, event: dict[str, Any]):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.lagged = True
+
+
+class InMemoryBackend:
+    def __init__(self, broker: "EventBroker"):
+        self.broker = broker
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event: dict[str, Any]):
+        self.broker.deliver(event)
+
+
+class MongoChangeStreamBackend(BackgroundTask):
+    def __init__(self, broker: "EventBroker"):
+        super().__init__()
+        self.broker = broker
+
+    # Change streams are only available on replica sets and sharded clusters
+    @staticmethod
+    async def is_supported() -> bool:
+        hello = await RealtimeEvent.get_motor_collection().database.command("hello")
+        return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+    async def publish(self, event: dict[str, Any]):
+        await RealtimeEvent(**event).insert()
+
+    # Delivers the events published by every worker to the local subscribers
+    async def _run(self):
+        collection = RealtimeEvent.get_motor_collection()
+        while True:
+            try:
+                async with collection.watch([{"$match": {"operationType": "insert"}}]) as stream:
+                    async for change in stream:
+                        document = change["fullDocument"]
+                        self.broker.deliver({
+                            "channel": document["channel"],
+                            "type": document["type"],
+                            "data": document["data"]
+                        })
+
+            # If the stream breaks (e.g. on a replica set election) reopens it after a moment
+            except PyMongoError:
+                logger.exception("Realtime change stream failed, reopening it")
+                await asyncio.sleep(1)
+
+
+class EventBroker:
+    def __init__(self):
+        self._subscriptions: dict[str, set[Subscription]] = defaultdict(set)
+        self.backend = InMemoryBackend(self)
+
+    async def start(self):
+        if REALTIME_BACKEND == "mongo":
+            if await MongoChangeStreamBackend.is_supported():
+                self.backend = MongoChangeStreamBackend(self)
+            else:
+                logger.warning(
+                    "Change streams aren't supported by the database, "
+                    "falling back to the in-memory realtime backend"
+                )
+        await self.backend.start()
+
+    async def stop(self):
+        await self.backend.stop()
+
+    def subscribe(self, channel: str) -> Subscription:
+        subscription = Subscription(channel)
+        self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.channel)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscriptions[subscription.channel]
+
+    async def publish(self, channel: str, event_type: str, data: dict[str, Any] | None = None):
+        await self.backend.publish({"channel": channel, "type": event_type, "data": data or {}})
+
+    # Delivers an event to the subscribers of this worker
+    def deliver(self, event: dict[str, Any]):
+        for subscription in self._subscriptions.get(event["channel"], ()):
+            subscription.put(event)
+
+
+broker = EventBroker()
@@ -0,0 +1,22 @@
+from datetime import datetime
+from typing import Any
+
+from pydantic import Field
+from pymongo import IndexModel
+from beanie import Document
+
+
+# Events published through the mongo backend of the broker. Each worker watches this
+# collection through a change stream and fans out inserted events to its local subscribers.
+# Events are only needed while they are being delivered, so they expire after a few minutes.
+class RealtimeEvent(Document):
+    channel: str
+    type: str
+    data: dict[str, Any] = {}
+    createdAt: datetime = Field(default_factory=datetime.utcnow)
+
+    class Settings:
+        name = "realtimeEvents"
+        indexes = [
+            IndexModel([("createdAt", 1)], expireAfterSeconds=60 * 5)
+        ]
@@ -0,0 +1,67 @@
+from typing import Annotated
+import asyncio
+import json
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+
+from .broker import broker, group_channel, user_channel
+from ..groups.models import Group
+from ..groups.dependencies import fetch_group_and_prefetch_user
+from ..groups.utils import check_user_is_group_admin
+from ..registration.models import User
+from ..miscellaneous.dependencies import get_current_user
+
+
+HEARTBEAT_INTERVAL = 15 # Seconds between keep-alive comments sent on idle streams
+
+router = APIRouter(tags=["realtime"])
+
+
+# Yields the events published to the channel formatted as server-sent events. While there are
+# no events a comment is sent periodically so proxies don't close the idle connection
+async def event_stream(channel: str):
+    subscription = broker.subscribe(channel)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+
+            yield f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+            # If events were dropped because the client wasn't reading fast enough, tells it
+            # to refetch its state and closes the stream
+            if subscription.lagged and subscription.queue.empty():
+                yield "event: resync\ndata: {}\n\n"
+                break
+
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def sse_response(channel: str):
+    return StreamingResponse(
+        event_stream(channel),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# Stream of join requests and membership changes of a group, reserved for its admins
+@router.get("/groups/{groupId}/events/")
+async def group_events(
+    group: Annotated[Group, Depends(fetch_group_and_prefetch_user)],
+    user: Annotated[User, Depends(get_current_user)]
+):
+    check_user_is_group_admin(user, group)
+    return sse_response(group_channel(group.id))
+
+
+# Stream of changes on the memberships of the current user (approvals, removals, etc)
+@router.get("/me/events/")
+async def user_events(user: Annotated[User, Depends(get_current_user)]):
+    return sse_response(user_channel(user.id))
@@ -0,0 +1,56 @@
+# bcrypt cost calibration.
+#
+# Benchmarks bcrypt on the current host and prints the highest cost factor whose hashing time
+# stays under the target (250 ms by default). Run it on the hardware the app is deployed to and
+# set the result as BCRYPT_ROUNDS:
+#
+#   python -m app.registration.calibrate_bcrypt [--target-ms 250] [--samples 5]
+#
+# Stored passwords with a different cost are rehashed transparently on their owner's next
+# sign in (see registration/utils.py).
+
+import argparse
+import statistics
+import time
+
+from passlib.hash import bcrypt
+
+
+MIN_ROUNDS = 10 # Below this bcrypt is considered too weak whatever the hardware
+MAX_ROUNDS = 16
+
+
+def measure(rounds: int, samples: int) -> float:
+    hasher = bcrypt.using(rounds=rounds)
+    timings = []
+
+    for _ in range(samples):
+        start = time.perf_counter()
+        hasher.hash("calibration-password")
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings) * 1000
+
+
+def calibrate(target_ms: float, samples: int) -> int:
+    chosen = MIN_ROUNDS
+
+    for rounds in range(MIN_ROUNDS, MAX_ROUNDS + 1):
+        elapsed = measure(rounds, samples)
+        print(f"rounds={rounds}: {elapsed:.1f} ms")
+
+        if elapsed > target_ms:
+            break
+
+        chosen = rounds
+
+    return chosen
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Picks a bcrypt cost factor for this host")
+    parser.add_argument("--target-ms", type=float, default=250)
+    parser.add_argument("--samples", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"BCRYPT_ROUNDS={calibrate(args.target_ms, args.samples)}")
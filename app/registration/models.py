@@ -1,8 +1,9 @@
 from datetime import datetime, timedelta
 import uuid
 
-from beanie import Document, before_event, Replace
+from beanie import Document, before_event, Replace, Indexed, PydanticObjectId
 from pydantic import BaseModel, EmailStr, Field
+from pymongo import IndexModel
 
 from . import enums
 
@@ -25,12 +26,15 @@ class UserBase(BaseModel):
 # ********* BEANIE MODELS *********
 
 class User(Document, UserBase):
+    email: Indexed(EmailStr, unique=True)
     password: str
     createdAt: datetime = Field(default_factory=datetime.utcnow)
     updatedAt: datetime = Field(default_factory=datetime.utcnow)
+    lastActiveAt: datetime | None = None # Written in batches, see registration/presence.py
 
     class Settings:
         name = "users"
+        use_revision = True
 
     @before_event(Replace)
     def update_updatedAt_field(self):
@@ -48,12 +52,33 @@ class UserDraft(Document, UserBase):
 
     class Settings:
         name = "draftUsers"
+        indexes = [
+            IndexModel([("email.value", 1)], unique=True)
+        ]
 
 
 class PwdResetToken(Document):
-    value: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    value: Indexed(str, unique=True) = Field(default_factory=lambda: str(uuid.uuid4()))
     expirationDate: datetime = datetime.utcnow() + timedelta(minutes=5)
-    userEmail: EmailStr
+    userEmail: Indexed(EmailStr)
 
     class Settings:
         name = "pwdResetTokens"
+
+
+# Revoked authentication tokens. A record either revokes a single token (jti) or every token of
+# the user issued before notBefore (logout from all sessions, password resets). Records are only
+# needed while the tokens they revoke could still be used, so they expire with them
+class TokenRevocation(Document):
+    userId: PydanticObjectId
+    jti: str | None = None
+    notBefore: float | None = None # Timestamp, tokens issued before it are revoked
+    expiresAt: datetime
+    createdAt: datetime = Field(default_factory=datetime.utcnow)
+
+    class Settings:
+        name = "tokenRevocations"
+        indexes = [
+            IndexModel([("expiresAt", 1)], expireAfterSeconds=0),
+            IndexModel([("createdAt", 1)])
+        ]
@@ -0,0 +1,57 @@
+# Write-coalesced tracking of the last time each user was active (User.lastActiveAt).
+#
+# get_current_user records the activity of the authenticated user in an in-memory map of this
+# worker (user id -> last activity), so handling a request doesn't write to the database. Every
+# PRESENCE_FLUSH_INTERVAL seconds the map is swapped for an empty one and written in a single
+# unordered bulk_write of $max updates, so the write rate depends on the number of active users
+# and the interval, not on the number of requests. $max makes the writes of different workers
+# commute: a late flush never moves lastActiveAt backwards. The map is flushed on shutdown too.
+
+from datetime import datetime
+import logging
+
+from beanie import PydanticObjectId
+from decouple import config
+from pymongo import UpdateOne
+
+from .models import User
+from ..miscellaneous.background import PeriodicTask
+
+
+PRESENCE_FLUSH_INTERVAL = config("PRESENCE_FLUSH_INTERVAL", default=60, cast=float) # Seconds
+
+FLUSH_BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceTracker(PeriodicTask):
+    run_on_stop = True
+
+    def __init__(self, flush_interval: float, batch_size: int):
+        super().__init__(flush_interval)
+        self.batch_size = batch_size
+        self._pending: dict[PydanticObjectId, datetime] = {}
+
+    def record(self, user_id: PydanticObjectId):
+        self._pending[user_id] = datetime.utcnow()
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        updates = [
+            UpdateOne({"_id": user_id}, {"$max": {"lastActiveAt": last_active}})
+            for user_id, last_active in pending.items()
+        ]
+
+        for i in range(0, len(updates), self.batch_size):
+            batch = updates[i:i + self.batch_size]
+            try:
+                await User.get_motor_collection().bulk_write(batch, ordered=False)
+            except Exception: # pylint: disable=W0718
+                logger.exception("Couldn't write the last activity of %s users", len(batch))
+
+    async def run_once(self):
+        await self.flush()
+
+
+presence_tracker = PresenceTracker(PRESENCE_FLUSH_INTERVAL, FLUSH_BATCH_SIZE)
@@ -0,0 +1,120 @@
+# Deny list of revoked authentication tokens.
+#
+# Revocations are persisted in the tokenRevocations collection (with a TTL matching the tokens
+# they revoke), and each worker keeps a compact copy in memory: the "not before" timestamp of
+# every user that logged out from all sessions and the set of revoked token ids (jti). Checking
+# a token is then two dict lookups with no I/O, so get_current_user doesn't pay for it.
+#
+# The copy is refreshed incrementally every REVOCATION_REFRESH_INTERVAL seconds, reading only
+# the records created since the last refresh (with some overlap to tolerate clock skew between
+# workers). Revocations made by this worker apply right away; the ones made by other workers
+# apply at most one refresh interval later.
+
+from datetime import datetime, timedelta, timezone
+import time
+
+from beanie import PydanticObjectId
+from decouple import config
+
+from .models import TokenRevocation
+from ..miscellaneous.background import PeriodicTask
+
+
+REVOCATION_REFRESH_INTERVAL = config(
+    "REVOCATION_REFRESH_INTERVAL", default=2, cast=float
+) # Seconds
+
+REFRESH_OVERLAP = timedelta(seconds=30)
+
+
+class RevocationList(PeriodicTask):
+    failure_message = "Couldn't refresh the token revocation list"
+
+    def __init__(self, refresh_interval: float):
+        super().__init__(refresh_interval)
+        self._not_before: dict[str, tuple[float, float]] = {} # user id -> (not before, expires)
+        self._revoked_jtis: dict[str, float] = {} # jti -> expires
+        self._last_refresh: datetime | None = None
+
+    def is_revoked(self, payload: dict) -> bool:
+        if payload.get("jti") in self._revoked_jtis:
+            return True
+
+        # Tokens issued before the revocation of all sessions of the user. Tokens without iat
+        # (issued before revocations existed) are revoked by any of them
+        if entry := self._not_before.get(payload.get("sub")):
+            return payload.get("iat", 0) < entry[0]
+
+        return False
+
+    def _apply(self, revocation: TokenRevocation):
+        expires = revocation.expiresAt.replace(tzinfo=timezone.utc).timestamp()
+        if revocation.jti:
+            self._revoked_jtis[revocation.jti] = expires
+
+        if revocation.notBefore:
+            user_id = str(revocation.userId)
+            current = self._not_before.get(user_id, (0.0, 0.0))
+            self._not_before[user_id] = (
+                max(current[0], revocation.notBefore), max(current[1], expires)
+            )
+
+    # Forgets the revocations of tokens that already expired on their own
+    def _prune(self):
+        now = time.time()
+        self._revoked_jtis = {
+            jti: expires for jti, expires in self._revoked_jtis.items() if expires > now
+        }
+        self._not_before = {
+            user_id: entry for user_id, entry in self._not_before.items() if entry[1] > now
+        }
+
+    async def _persist(self, revocation: TokenRevocation):
+        self._apply(revocation)
+        await revocation.insert()
+
+    # Revokes a single token, given its decoded payload
+    async def revoke_token(self, payload: dict):
+        await self._persist(TokenRevocation(
+            userId=PydanticObjectId(payload["sub"]),
+            jti=payload["jti"],
+            expiresAt=datetime.utcfromtimestamp(payload["exp"])
+        ))
+
+    # Revokes every token of the user issued until now
+    async def revoke_all(self, user_id: PydanticObjectId, expires_at: datetime):
+        await self._persist(TokenRevocation(
+            userId=user_id,
+            notBefore=time.time(),
+            expiresAt=expires_at
+        ))
+
+    async def refresh(self):
+        started_at = datetime.utcnow()
+        query = {}
+        if self._last_refresh:
+            query = {"createdAt": {"$gte": self._last_refresh - REFRESH_OVERLAP}}
+
+        async for revocation in TokenRevocation.find(query):
+            self._apply(revocation)
+
+        self._last_refresh = started_at
+        self._prune()
+
+    # The first refresh is awaited, so the revoked tokens are loaded before serving any request
+    async def start(self):
+        await self.refresh()
+        await super().start()
+
+    async def run_once(self):
+        await self.refresh()
+
+    def stats(self) -> dict:
+        return {
+            "revokedTokens": len(self._revoked_jtis),
+            "revokedUsers": len(self._not_before),
+            "lastRefresh": self._last_refresh
+        }
+
+
+revocation_list = RevocationList(REVOCATION_REFRESH_INTERVAL)
@@ -2,22 +2,33 @@ from typing import Annotated
 from datetime import datetime, timedelta
 import random
 import string
+import asyncio
 import textwrap
+import time
+import uuid
 import os
 
-from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, Body
+from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, Body, BackgroundTasks
 from fastapi.responses import JSONResponse
 from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import EmailStr
 from decouple import config
-from passlib.context import CryptContext
 from jose import jwt
+from pymongo.errors import DuplicateKeyError
+from beanie.odm.utils.dump import get_dict
 
 from . import schemas
 from .models import User, UserDraft, PwdResetToken
-from ..groups.models import Group
-from ..miscellaneous.dependencies import get_current_user, validate_upload_file
+from .utils import (
+    hash_password, verify_password, password_needs_rehash, rehash_password, encode_sync_cursor,
+    decode_sync_cursor
+)
+from .revocation import revocation_list
+from ..groups.models import Group, MembershipTombstone, MEMBERSHIP_TOMBSTONE_TTL
+from ..miscellaneous.dependencies import (
+    get_current_user, get_token_payload, validate_upload_file
+)
 from ..miscellaneous.utils import get_media_root
 from ..email_utils.send_email import send_verification_code_email, send_password_reset_email
 
@@ -42,7 +53,10 @@ AUTH_TOKEN_EXPIRATION_MINUTES = 60 * 24 * 2
 
 VERIF_CODE_RESEND_T = 3 # Minutes between verif. code resends and code valid time
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Changes are looked up since a bit before the cursor, so writes that took their timestamp
+# before the previous sync but were committed after it (or on a worker with a slightly
+# different clock) aren't missed. Clients may get some changes twice, applying them is idempotent
+SYNC_CURSOR_OVERLAP = timedelta(seconds=30)
 
 router = APIRouter(tags=["registration"])
 
@@ -50,29 +64,45 @@ router = APIRouter(tags=["registration"])
 def generate_authentication_token(user_id):
     expires = datetime.utcnow() + timedelta(minutes=AUTH_TOKEN_EXPIRATION_MINUTES)
     encoded_jwt = jwt.encode(
-        {"sub": str(user_id), "exp": expires},
+        # jti identifies the token so it can be revoked alone, and iat (with sub-second
+        # precision) tells if it was issued before the user logged out from all sessions
+        {"sub": str(user_id), "exp": expires, "iat": time.time(), "jti": uuid.uuid4().hex},
         SECRET_KEY,
         algorithm=ALGORITHM
     )
 
     return {"accessToken": encoded_jwt, "tokenType": "bearer"}
 
-# TODO: comment this function
-async def save_and_send_verif_code(email: str):
-    now = datetime.utcnow()
 
+# Revokes every token issued to the user until now. Revocations are kept as long as those tokens
+# could still be used
+async def revoke_all_tokens(user_id):
+    await revocation_list.revoke_all(
+        user_id,
+        expires_at=datetime.utcnow() + timedelta(minutes=AUTH_TOKEN_EXPIRATION_MINUTES)
+    )
+
+
+def generate_verif_code():
     characters = string.ascii_letters + string.digits
-    code = ''.join(random.choice(characters) for _ in range(6))
+    return ''.join(random.choice(characters) for _ in range(6))
+
 
-    # Updates verif code and issued time on corresponding user for the given email
-    draft_user = await UserDraft.find_one(UserDraft.email.value == email)
-    draft_user.email.code = code
-    draft_user.email.codeIssuedAt = now
-    await draft_user.replace()
+# Saves the draft user with its verification code already attached in a single upsert, replacing
+# any previous draft for the same email, and sends the code
+async def save_draft_and_send_verif_code(draft_user: UserDraft):
+    collection = UserDraft.get_motor_collection()
+    draft_filter = {"email.value": draft_user.email.value}
+    document = get_dict(draft_user, to_db=True)
 
-    send_verification_code_email(email, code)
+    try:
+        await collection.replace_one(draft_filter, document, upsert=True)
+    except DuplicateKeyError:
+        # Two concurrent upserts for a new email may both try to insert, the unique index on
+        # the email lets only one of them in. Retrying matches the inserted draft and replaces it
+        await collection.replace_one(draft_filter, document, upsert=True)
 
-    return now + timedelta(minutes=VERIF_CODE_RESEND_T)
+    send_verification_code_email(draft_user.email.value, draft_user.email.code)
 
 
 @router.post(
@@ -83,13 +113,6 @@ async def save_and_send_verif_code(email: str):
     }
 )
 async def signup(form_data: schemas.UserCreate):
-    # Verifies it doesn't already exist a user with the provided email
-    if await User.find_one(User.email == form_data.email):
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail={"email": "Ya existe un usuario con el correo proporcionado"}
-        )
-
     # Validates that given passwords are equal
     if form_data.password != form_data.passwordConfirm:
         raise HTTPException(
@@ -98,26 +121,29 @@ async def signup(form_data: schemas.UserCreate):
         )
     # TODO: Validate password strongness
 
+    # Verifies it doesn't already exist a user with the provided email. This is just for giving
+    # early feedback, the unique index on the email is what prevents duplicated users (see
+    # verify_email)
+    if await User.find_one(User.email == form_data.email):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={"email": "Ya existe un usuario con el correo proporcionado"}
+        )
+
 
     # If no errors found in submitted data saves user as draft (in draftUsers collection).
     # When the user verifies them email, user will be moved to users collection
-
-    # if already exists in draftUsers a user with the given email delete them
-    if draft_user := await UserDraft.find_one(UserDraft.email.value == form_data.email):
-        await draft_user.delete()
-
-    # saves user as draft
-    await UserDraft(
+    await save_draft_and_send_verif_code(UserDraft(
         **form_data.model_dump(exclude=[
             "email", "password", "passwordConfirm"
         ]),
-        password = pwd_context.hash(form_data.password),
+        password = await hash_password(form_data.password),
         email = {
-            "value": form_data.email
+            "value": form_data.email,
+            "code": generate_verif_code(),
+            "codeIssuedAt": datetime.utcnow()
         },
-    ).insert()
-
-    await save_and_send_verif_code(form_data.email)
+    ))
 
     return JSONResponse(
         status_code=status.HTTP_307_TEMPORARY_REDIRECT,
@@ -133,35 +159,49 @@ async def verify_email(
     email: EmailStr,
     body: schemas.Code
 ):
-    if not (draft_user := await UserDraft.find_one(UserDraft.email.value == email)):
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"No se encontró ningún usuario con el correo <{email}>"
-        )
+    # Takes the draft out of draftUsers only if the given code is valid and hasn't expired, in a
+    # single atomic operation
+    draft_user = await UserDraft.get_motor_collection().find_one_and_delete({
+        "email.value": email,
+        "email.code": body.code,
+        "email.codeIssuedAt": {
+            "$gte": datetime.utcnow() - timedelta(minutes=VERIF_CODE_RESEND_T)
+        }
+    })
+
+    # If the draft wasn't taken finds out why (only happens on the error path)
+    if not draft_user:
+        if not (draft_user := await UserDraft.find_one(UserDraft.email.value == email)):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"No se encontró ningún usuario con el correo <{email}>"
+            )
 
-    # Verify given verification code is valid
-    if draft_user.email.code != body.code:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="El código de verificación que proporcionaste no es valido"
-        )
+        if draft_user.email.code != body.code:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="El código de verificación que proporcionaste no es valido"
+            )
 
-    if (
-        datetime.utcnow() >
-        draft_user.email.codeIssuedAt + timedelta(minutes=VERIF_CODE_RESEND_T)
-    ):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="El código de verificación que proporcionaste ya expiró"
         )
 
     # If verification code is valid moves user to users collection, and returns the auth token
-    user = await User(
-        **draft_user.model_dump(exclude=["id", "email", "draftedAt"]),
-        email = draft_user.email.value,
-    ).insert()
+    draft_user = UserDraft.model_validate(draft_user)
+    try:
+        user = await User(
+            **draft_user.model_dump(exclude=["id", "email", "draftedAt"]),
+            email = draft_user.email.value,
+        ).insert()
 
-    await draft_user.delete()
+    # The unique index on the email rejects the user if someone else verified it first
+    except DuplicateKeyError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={"email": "Ya existe un usuario con el correo proporcionado"}
+        ) from exc
 
     return generate_authentication_token(user.id)
 
@@ -176,21 +216,27 @@ async def verify_email(
 async def resend_verification_code(
     email: str
 ) -> str:
+    now = datetime.utcnow()
+    code = generate_verif_code()
+
+    # Replaces the verification code only if it has passed the minimum time between code
+    # resends, checking and updating in a single atomic operation
+    result = await UserDraft.find_one(
+        UserDraft.email.value == email,
+        UserDraft.email.codeIssuedAt <= now - timedelta(minutes=VERIF_CODE_RESEND_T)
+    ).update({"$set": {"email.code": code, "email.codeIssuedAt": now}})
+
+    if result.modified_count:
+        send_verification_code_email(email, code)
+        return (now + timedelta(minutes=VERIF_CODE_RESEND_T)).isoformat()
+
+    # If the code wasn't replaced finds out why
     if not (draft_user := await UserDraft.find_one(UserDraft.email.value == email)):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"No se encontró ningún usuario con el correo <{email}>"
         )
 
-    # Verifies it has passed the minimum time betwee code resends and if so then generates,
-    # saves and sends the new verification code
-    if (
-        datetime.utcnow() >
-        draft_user.email.codeIssuedAt + timedelta(minutes=VERIF_CODE_RESEND_T)
-    ):
-        code_available_until = await save_and_send_verif_code(email)
-        return code_available_until.isoformat()
-
     else:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -220,17 +266,27 @@ async def resend_verification_code(
         404: {"description": "User not found"}
     }
 )
-async def signin(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
+async def signin(
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    background_tasks: BackgroundTasks
+):
     # Searches a user which matches the given email (username)
     if user := await User.find_one(User.email == form_data.username):
 
-        if not pwd_context.verify(form_data.password, user.password):
+        if not await verify_password(form_data.password, user.password):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 headers={"WWW-Authenticate": "Bearer"},
                 detail={"noField": "El correo y la contraseña no coinciden"}
             )
 
+        # If the password was hashed with a cost other than the configured one, rehashes it
+        # after the response is sent
+        if password_needs_rehash(user.password):
+            background_tasks.add_task(
+                rehash_password, user.id, form_data.password, user.password
+            )
+
         return generate_authentication_token(user.id)
 
     # Searches if given email corresponds to user in draft
@@ -300,14 +356,38 @@ async def reset_password(token: str, newPassword: str = Body(embed=True)):
         )
 
     user = await User.find_one(User.email == pwd_rst_tkn.userEmail)
-    user.password = pwd_context.hash(newPassword)
-    await user.replace()
+    await user.set({
+        User.password: await hash_password(newPassword),
+        User.updatedAt: datetime.utcnow()
+    })
 
     await pwd_rst_tkn.delete()
 
+    # Whoever had access to the account with the old password loses it
+    await revoke_all_tokens(user.id)
+
     return {"msg": "Contraseña restaurada exitosamente"}
 
 
+@router.post("/logout/")
+async def logout(payload: Annotated[dict, Depends(get_token_payload)]):
+    # Tokens issued before revocations existed don't have a jti, the only way to revoke them is
+    # revoking every session of the user
+    if "jti" in payload:
+        await revocation_list.revoke_token(payload)
+    else:
+        await revoke_all_tokens(payload["sub"])
+
+    return {"msg": "ok"}
+
+
+@router.post("/logout-all/")
+async def logout_all(user: Annotated[User, Depends(get_current_user)]):
+    await revoke_all_tokens(user.id)
+
+    return {"msg": "ok"}
+
+
 @router.get("/me/", response_model=schemas.ProfileResponse)
 async def get_profile_data(user=Depends(get_current_user)):
     return user
@@ -324,15 +404,67 @@ async def get_groups_iam_member(user: Annotated[User, Depends(get_current_user)]
     return {"groups": await Group.find(Group.members.id == user.id).to_list()}
 
 
+# Delta sync for clients that keep a local copy of the profile and the groups of the user. Returns
+# only what changed since the cursor of the previous sync: the profile if it was updated, the
+# groups (where the user is admin or member) that were updated and the ids of the groups the
+# user no longer belongs to. Without a cursor, or with one older than the tombstones of removed
+# memberships, returns a full snapshot (fullResync) which replaces the local copy
+@router.get("/sync/", response_model=schemas.SyncResponse)
+async def sync(user: Annotated[User, Depends(get_current_user)], since: str | None = None):
+    synced_at = datetime.utcnow()
+    changed_since = decode_sync_cursor(since) if since else None
+    full_resync = (
+        changed_since is None or changed_since < synced_at - MEMBERSHIP_TOMBSTONE_TTL
+    )
+
+    if full_resync:
+        groups = await Group.find(
+            {"$or": [{"admins.$id": user.id}, {"members.$id": user.id}]}
+        ).to_list()
+        tombstones = []
+
+    else:
+        changed_since -= SYNC_CURSOR_OVERLAP
+        groups, tombstones = await asyncio.gather(
+            Group.find({"$or": [
+                {"admins.$id": user.id, "updatedAt": {"$gt": changed_since}},
+                {"members.$id": user.id, "updatedAt": {"$gt": changed_since}}
+            ]}).to_list(),
+            MembershipTombstone.find(
+                MembershipTombstone.userId == user.id,
+                MembershipTombstone.createdAt > changed_since
+            ).to_list()
+        )
+
+    is_admin = {
+        group.id: user.id in [link.ref.id for link in group.admins] for group in groups
+    }
+
+    return {
+        "cursor": encode_sync_cursor(synced_at),
+        "fullResync": full_resync,
+        "profile": user if full_resync or user.updatedAt > changed_since else None,
+        "adminGroups": [group for group in groups if is_admin[group.id]],
+        "memberGroups": [group for group in groups if not is_admin[group.id]],
+        # A group the user left and joined again since the cursor is returned as changed, not
+        # as removed
+        "removedGroupIds": list({
+            tombstone.groupId for tombstone in tombstones if tombstone.groupId not in is_admin
+        })
+    }
+
+
 @router.patch("/me/", response_model=schemas.ProfileResponse)
 async def profile_patch(
     profilePatch: schemas.ProfilePatch,
     user = Depends(get_current_user)
 ):
-    for key, value in profilePatch.model_dump(exclude_unset=True).items():
-        setattr(user, key, value)
-    await user.replace()
-    await user.sync()
+    # Only sets the patched fields, checking the user wasn't modified since it was fetched and
+    # getting back the updated document in the same operation
+    await user.set({
+        **profilePatch.model_dump(exclude_unset=True),
+        User.updatedAt: datetime.utcnow()
+    })
 
     return user
 
@@ -353,8 +485,7 @@ async def update_profile_image(
             new_file.write(await profile_image.read())
 
         profile_image = "/media" + path
-        user.profileImage = profile_image
-        await user.replace()
+        await user.set({User.profileImage: profile_image, User.updatedAt: datetime.utcnow()})
 
     except Exception as exc:
         raise HTTPException(
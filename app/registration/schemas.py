@@ -50,5 +50,18 @@ class ListGroup(BaseModel):
     groupImage: str | None = None
     groupColor: str | None = None
     accessibility: groups_enums.AccessibilityEnum
+    memberCount: int = 0
+    adminCount: int = 0
+    pendingRequestCount: int = 0
 class GroupsResponse(BaseModel):
     groups: list[ListGroup]
+
+
+# get /sync/
+class SyncResponse(BaseModel):
+    cursor: str
+    fullResync: bool = False
+    profile: ProfileResponse | None = None
+    adminGroups: list[ListGroup] = []
+    memberGroups: list[ListGroup] = []
+    removedGroupIds: list[StrObjectId] = []
@@ -0,0 +1,77 @@
+from datetime import datetime, timezone
+import base64
+
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from decouple import config
+from passlib.context import CryptContext
+from beanie import PydanticObjectId
+
+from .models import User
+
+
+# ENVIRONMENT VARIABLES
+# bcrypt cost factor, pick it for the hardware the app runs on with
+# python -m app.registration.calibrate_bcrypt
+BCRYPT_ROUNDS = config("BCRYPT_ROUNDS", default=12, cast=int)
+
+
+# MODULE'S GLOBAL VARIABLES
+# Pinning min and max rounds to the configured cost makes needs_update report every stored hash
+# with a different cost, so it gets rehashed the next time its owner signs in
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS
+)
+
+
+# bcrypt is CPU bound on purpose, hashing and verifying run in the threadpool so they don't
+# block the event loop
+async def hash_password(password: str) -> str:
+    return await run_in_threadpool(pwd_context.hash, password)
+
+
+async def verify_password(password: str, password_hash: str) -> bool:
+    return await run_in_threadpool(pwd_context.verify, password, password_hash)
+
+
+def password_needs_rehash(password_hash: str) -> bool:
+    return pwd_context.needs_update(password_hash)
+
+
+# Replaces the stored hash with one using the current cost. Only replaces it if it's still the
+# hash that was verified, so a password reset happening meanwhile is never overwritten
+async def rehash_password(user_id: PydanticObjectId, password: str, old_hash: str):
+    new_hash = await hash_password(password)
+
+    await User.find_one(
+        User.id == user_id,
+        User.password == old_hash
+    ).update({"$set": {User.password: new_hash}})
+
+
+# Cursors for delta sync. They are opaque to clients, and encode the moment of the sync that
+# returned them
+def encode_sync_cursor(synced_at: datetime) -> str:
+    return base64.urlsafe_b64encode(synced_at.isoformat().encode()).decode()
+
+
+# Cursors are naive UTC, like every datetime of the app. A cursor with a timezone (not issued by
+# encode_sync_cursor, but valid ISO) is converted, so it can be compared with them
+def decode_sync_cursor(cursor: str) -> datetime:
+    try:
+        synced_at = datetime.fromisoformat(base64.urlsafe_b64decode(cursor.encode()).decode())
+
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="El cursor proporcionado no es valido"
+        ) from exc
+
+    if synced_at.tzinfo:
+        synced_at = synced_at.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return synced_at
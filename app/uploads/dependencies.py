@@ -0,0 +1,20 @@
+from typing import Annotated
+
+from fastapi import Depends, HTTPException, status
+
+from .models import UploadSession
+from ..registration.models import User
+from ..miscellaneous.dependencies import get_current_user
+
+
+async def fetch_upload_session(
+    uploadId: str,
+    user: Annotated[User, Depends(get_current_user)]
+):
+    if not (upload := await UploadSession.get(uploadId)) or upload.owner != user.id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="La sesión de subida solicitada no existe o ya expiró"
+        )
+
+    return upload
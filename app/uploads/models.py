@@ -0,0 +1,28 @@
+from datetime import datetime
+
+from pydantic import Field
+from pymongo import IndexModel
+from beanie import Document, PydanticObjectId
+
+
+UPLOAD_SESSION_TTL = 60 * 60 * 24 # Seconds an unfinished upload session can be resumed
+
+
+class UploadSession(Document):
+    owner: PydanticObjectId
+    filename: str
+    contentType: str
+    size: int
+    sha256: str # Hex digest of the whole file, computed by the client
+    # Byte ranges [start, end) received so far. Chunks are pushed atomically, so concurrent
+    # chunk uploads of the same session never overwrite each other's progress
+    chunks: list[tuple[int, int]] = []
+    mediaPath: str | None = None # Set once the upload is finalized
+    finalizingAt: datetime | None = None # Set while a request is finalizing the upload
+    createdAt: datetime = Field(default_factory=datetime.utcnow)
+
+    class Settings:
+        name = "uploadSessions"
+        indexes = [
+            IndexModel([("createdAt", 1)], expireAfterSeconds=UPLOAD_SESSION_TTL)
+        ]
@@ -0,0 +1,172 @@
+# Resumable uploads for post multimedia.
+#
+# The client creates an upload session declaring the size and sha256 of the file, then sends
+# the file in chunks (in any order, and retrying any of them) with PUT requests at byte offsets,
+# which are written in place with positional writes. If the connection drops the client asks
+# for the progress and only sends the missing ranges. Finally the upload is finalized, which
+# verifies the checksum and moves the file into the media store with a rename (no copy).
+
+from typing import Annotated
+from datetime import datetime, timedelta
+import os
+
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from decouple import config
+
+from . import schemas
+from .models import UploadSession
+from .dependencies import fetch_upload_session
+from .utils import (
+    get_partial_file_path, get_upload_progress, merge_ranges, check_upload_content_type,
+    file_sha256
+)
+from ..registration.models import User
+from ..miscellaneous.dependencies import get_current_user
+from ..miscellaneous.utils import get_media_root
+
+
+MEDIA_ROOT = get_media_root()
+
+UPLOAD_MAX_SIZE = config("UPLOAD_MAX_SIZE", default=1024**3, cast=int) # Bytes
+
+WRITE_BUFFER_SIZE = 1024**2 # Bytes of the request body buffered before each disk write
+
+FINALIZE_CLAIM_TIMEOUT = 60 * 10 # Seconds
+
+router = APIRouter(prefix="/uploads", tags=["uploads"])
+
+
+@router.post("/", response_model=schemas.UploadProgress)
+async def create_upload_session(
+    uploadCreate: schemas.UploadSessionCreate,
+    user: Annotated[User, Depends(get_current_user)]
+):
+    check_upload_content_type(uploadCreate.contentType)
+
+    if uploadCreate.size > UPLOAD_MAX_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"El archivo no puede pesar mas de {UPLOAD_MAX_SIZE // 1000**2} MB"
+        )
+
+    upload = await UploadSession(
+        owner=user.id,
+        filename=uploadCreate.filename,
+        contentType=uploadCreate.contentType,
+        size=uploadCreate.size,
+        sha256=uploadCreate.sha256.lower()
+    ).insert()
+
+    # Creates the (sparse) file where the chunks will be written
+    with open(get_partial_file_path(upload), "wb") as partial_file:
+        partial_file.truncate(upload.size)
+
+    return get_upload_progress(upload)
+
+
+@router.get("/{uploadId}/", response_model=schemas.UploadProgress)
+async def get_upload_session_progress(
+    upload: Annotated[UploadSession, Depends(fetch_upload_session)]
+):
+    return get_upload_progress(upload)
+
+
+# The chunk is sent as the raw request body and streamed to disk as it arrives
+@router.put("/{uploadId}/", response_model=schemas.UploadProgress)
+async def upload_chunk(
+    request: Request,
+    upload: Annotated[UploadSession, Depends(fetch_upload_session)],
+    offset: Annotated[int, Query(ge=0)]
+):
+    if upload.mediaPath or upload.finalizingAt:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Esta subida ya fue finalizada"
+        )
+
+    position = offset
+    buffer = bytearray()
+    fd = os.open(get_partial_file_path(upload), os.O_WRONLY)
+    try:
+        async for data in request.stream():
+            if position + len(buffer) + len(data) > upload.size:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail="El fragmento excede el tamaño declarado del archivo"
+                )
+            buffer += data
+            if len(buffer) >= WRITE_BUFFER_SIZE:
+                position += await run_in_threadpool(os.pwrite, fd, bytes(buffer), position)
+                buffer.clear()
+
+    # Writes and registers whatever was received even if the request failed midway (e.g. the
+    # connection dropped, which raises ClientDisconnect), so the client can resume from there
+    finally:
+        try:
+            if buffer:
+                position += await run_in_threadpool(os.pwrite, fd, bytes(buffer), position)
+        finally:
+            os.close(fd)
+
+        if position > offset:
+            await upload.update({"$push": {"chunks": (offset, position)}})
+
+    return get_upload_progress(upload)
+
+
+@router.post("/{uploadId}/finalize/", response_model=schemas.UploadFinalized)
+async def finalize_upload(upload: Annotated[UploadSession, Depends(fetch_upload_session)]):
+    if upload.mediaPath:
+        return {"mediaPath": upload.mediaPath}
+
+    if merge_ranges(upload.chunks) != [(0, upload.size)]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Aún no se han recibido todos los fragmentos del archivo"
+        )
+
+    # Claims the session in a single atomic operation, so concurrent finalize requests don't race
+    # to move the same file. Claims older than FINALIZE_CLAIM_TIMEOUT are considered abandoned
+    # (e.g. the worker died while finalizing)
+    now = datetime.utcnow()
+    claim = await UploadSession.find_one({
+        "_id": upload.id,
+        "mediaPath": None,
+        "$or": [
+            {"finalizingAt": None},
+            {"finalizingAt": {"$lt": now - timedelta(seconds=FINALIZE_CLAIM_TIMEOUT)}}
+        ]
+    }).update({"$set": {"finalizingAt": now}})
+
+    if not claim.modified_count:
+        await upload.sync()
+        if upload.mediaPath:
+            return {"mediaPath": upload.mediaPath}
+
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="La subida ya se está finalizando, consulta su estado en unos momentos"
+        )
+
+    try:
+        partial_path = get_partial_file_path(upload)
+        if await run_in_threadpool(file_sha256, partial_path) != upload.sha256:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="El archivo recibido está corrupto, la suma de verificación no coincide"
+            )
+
+        # Moves the file into the media store. Both directories are in the media root (same
+        # filesystem), so it's just a rename
+        path = f"/postMultimedia/{str(upload.id)}.{upload.filename.split('.')[-1]}"
+        os.replace(partial_path, MEDIA_ROOT + path)
+
+    # Releases the claim so the upload can be fixed and finalized again
+    except Exception:
+        await upload.set({UploadSession.finalizingAt: None})
+        raise
+
+    await upload.set({UploadSession.mediaPath: "/media" + path})
+
+    return {"mediaPath": upload.mediaPath}
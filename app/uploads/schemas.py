@@ -0,0 +1,28 @@
+from pydantic import BaseModel, Field
+
+
+# ********* Request schemas *********
+
+# post /uploads/
+class UploadSessionCreate(BaseModel):
+    filename: str
+    contentType: str
+    size: int = Field(gt=0)
+    sha256: str = Field(pattern=r"^[0-9a-fA-F]{64}$")
+
+
+# ********* Response schemas *********
+
+# post /uploads/
+# put /uploads/{uploadId}/
+# get /uploads/{uploadId}/
+class UploadProgress(BaseModel):
+    uploadId: str
+    size: int
+    receivedBytes: int
+    missingRanges: list[tuple[int, int]]
+
+
+# post /uploads/{uploadId}/finalize/
+class UploadFinalized(BaseModel):
+    mediaPath: str
@@ -0,0 +1,86 @@
+# Deletes the partial files of upload sessions that no longer exist.
+#
+# Unfinished sessions are removed by the TTL index of their collection, which can't delete the
+# file the chunks were written to. Every UPLOADS_SWEEP_INTERVAL seconds the files in the
+# uploadSessions directory are matched against the existing sessions (in batches of $in queries)
+# and the ones without a session are deleted. Files younger than SWEEP_GRACE_PERIOD are skipped,
+# so sessions being created are never touched.
+
+import logging
+import os
+import time
+
+from beanie import PydanticObjectId
+from beanie.operators import In
+from bson.errors import InvalidId
+from decouple import config
+from fastapi.concurrency import run_in_threadpool
+
+from .models import UploadSession
+from ..miscellaneous.utils import get_media_root
+from ..miscellaneous.background import PeriodicTask
+
+
+UPLOADS_SWEEP_INTERVAL = config("UPLOADS_SWEEP_INTERVAL", default=60 * 60, cast=float) # Seconds
+
+SWEEP_GRACE_PERIOD = 60 * 10 # Seconds
+SWEEP_BATCH_SIZE = 500
+
+UPLOAD_SESSIONS_DIR = os.path.join(get_media_root(), "uploadSessions")
+
+logger = logging.getLogger(__name__)
+
+
+# Blocking, meant to be run in a thread. Returns the ids of the partial files old enough to be
+# swept
+def list_partial_files() -> list[str]:
+    now = time.time()
+    with os.scandir(UPLOAD_SESSIONS_DIR) as entries:
+        return [
+            entry.name for entry in entries
+            if entry.is_file() and now - entry.stat().st_mtime > SWEEP_GRACE_PERIOD
+        ]
+
+
+# Blocking, meant to be run in a thread
+def delete_partial_files(names: list[str]):
+    for name in names:
+        try:
+            os.remove(os.path.join(UPLOAD_SESSIONS_DIR, name))
+        except FileNotFoundError: # Already swept by another worker
+            pass
+
+
+async def sweep_partial_files() -> int:
+    names = await run_in_threadpool(list_partial_files)
+    orphans = []
+
+    for i in range(0, len(names), SWEEP_BATCH_SIZE):
+        batch = {}
+        for name in names[i:i + SWEEP_BATCH_SIZE]:
+            try:
+                batch[PydanticObjectId(name)] = name
+            except InvalidId:
+                orphans.append(name)
+
+        existing = {
+            upload.id for upload in await UploadSession.find(
+                In(UploadSession.id, list(batch))
+            ).to_list()
+        }
+        orphans += [name for upload_id, name in batch.items() if upload_id not in existing]
+
+    await run_in_threadpool(delete_partial_files, orphans)
+    return len(orphans)
+
+
+class UploadsSweeper(PeriodicTask):
+    run_on_start = True
+    failure_message = "Couldn't sweep the abandoned upload files"
+
+    async def run_once(self):
+        if swept := await sweep_partial_files():
+            logger.info("Deleted %s abandoned upload files", swept)
+
+
+uploads_sweeper = UploadsSweeper(UPLOADS_SWEEP_INTERVAL)
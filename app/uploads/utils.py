@@ -0,0 +1,64 @@
+import hashlib
+import os
+
+from fastapi import HTTPException, status
+
+from .models import UploadSession
+from ..miscellaneous.utils import get_media_root
+
+
+MEDIA_ROOT = get_media_root()
+
+HASH_READ_SIZE = 1024**2
+
+
+def get_partial_file_path(upload: UploadSession) -> str:
+    return os.path.join(MEDIA_ROOT, "uploadSessions", str(upload.id))
+
+
+def merge_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def get_upload_progress(upload: UploadSession) -> dict:
+    received = merge_ranges(upload.chunks)
+
+    missing = []
+    position = 0
+    for start, end in received:
+        if start > position:
+            missing.append((position, start))
+        position = end
+    if position < upload.size:
+        missing.append((position, upload.size))
+
+    return {
+        "uploadId": str(upload.id),
+        "size": upload.size,
+        "receivedBytes": sum(end - start for start, end in received),
+        "missingRanges": missing
+    }
+
+
+def check_upload_content_type(content_type: str):
+    if content_type.split("/")[0] not in ["image", "video", "audio"] and \
+            content_type != "application/pdf":
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Solo puedes subir imágenes, videos, audios o archivos pdf"
+        )
+
+
+# Blocking, meant to be run in a thread
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(HASH_READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -10,12 +10,32 @@ from jose.exceptions import ExpiredSignatureError, JWTError
 from bson.errors import InvalidId
 from motor.motor_asyncio import AsyncIOMotorClient
 from beanie import init_beanie
+from beanie.exceptions import RevisionIdWasChanged
 
 from app.registration.router import router as registration_router
 from app.groups.router import router as groups_router
-from app.registration.models import User, UserDraft, PwdResetToken
-from app.groups.models import Group
+from app.realtime.router import router as realtime_router
+from app.posts.router import router as posts_router
+from app.uploads.router import router as uploads_router
+from app.miscellaneous.router import router as metrics_router
+from app.registration.models import User, UserDraft, PwdResetToken, TokenRevocation
+from app.registration.revocation import revocation_list
+from app.registration.presence import presence_tracker
+from app.groups.models import (
+    Group, GroupRecommendation, RecommendationsRefresh, GroupActivity, MembershipTombstone
+)
+from app.groups.activity import activity_log
+from app.groups.recommendations import recommendations_refresher
+from app.posts.models import Post
+from app.uploads.models import UploadSession
+from app.uploads.sweeper import uploads_sweeper
+from app.groups.cache import group_cache
+from app.realtime.models import RealtimeEvent
+from app.realtime.broker import broker
 from app.miscellaneous.utils import get_media_root
+from app.miscellaneous.db_metrics import DBMetricsMiddleware, command_stats_listener
+from app.miscellaneous.profiling import ProfilingMiddleware, PROFILING_ENABLED
+from app.miscellaneous.compression import CompressionMiddleware
 
 
 DB_URL = config("DB_URL", cast=str)
@@ -26,23 +46,48 @@ ORIGIN = config("ORIGIN", cast=str)
 
 MEDIA_ROOT = get_media_root()
 
-beanie_models = [ User, UserDraft, PwdResetToken, Group ]
+beanie_models = [
+    User, UserDraft, PwdResetToken, TokenRevocation, Group, GroupRecommendation,
+    RecommendationsRefresh, GroupActivity, MembershipTombstone, RealtimeEvent, Post, UploadSession
+]
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Init beanie
-    app.mongo_client = AsyncIOMotorClient(DB_URL)
+    app.mongo_client = AsyncIOMotorClient(DB_URL, event_listeners=[command_stats_listener])
     await init_beanie(database=app.mongo_client[DB_NAME], document_models=beanie_models)
 
+    # Loads the revoked tokens before serving any request
+    await revocation_list.start()
+
+    # Starts the backend that fans out realtime events to subscribers
+    await broker.start()
+    await group_cache.start()
+    await recommendations_refresher.start()
+    await activity_log.start()
+    await presence_tracker.start()
+
     # Checks if directories for media files exist and if not create them
-    dirs = ["profileImages", "groupImages", "postMultimedia"]
+    dirs = ["profileImages", "groupImages", "postMultimedia", "uploadSessions"]
     for directory in dirs:
         if not os.path.isdir(os.path.join(MEDIA_ROOT, directory)):
             os.makedirs(os.path.join(MEDIA_ROOT, directory))
 
+    # Deletes the partial files of the upload sessions that expired
+    await uploads_sweeper.start()
+
     yield
 
+    # Writes the activity events and last activity of users still in memory before closing the
+    # connection
+    await activity_log.stop()
+    await presence_tracker.stop()
+    await recommendations_refresher.stop()
+    await group_cache.stop()
+    await broker.stop()
+    await revocation_list.stop()
+    await uploads_sweeper.stop()
     app.mongo_client.close()
 
 
@@ -56,8 +101,21 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+app.add_middleware(DBMetricsMiddleware)
+
+# Compresses large text responses (e.g. member listings) with brotli or gzip, as negotiated
+app.add_middleware(CompressionMiddleware)
+
+# Only installed when profiling is configured, so requests don't pay for it otherwise
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+
 app.include_router(registration_router)
 app.include_router(groups_router)
+app.include_router(realtime_router)
+app.include_router(posts_router)
+app.include_router(uploads_router)
+app.include_router(metrics_router)
 
 
 @app.exception_handler(ExpiredSignatureError)
@@ -88,3 +146,13 @@ def invalidid_error_handler(request, exc):
             "detail": "[InvalidId]"
         })
     )
+
+@app.exception_handler(RevisionIdWasChanged)
+def revision_id_was_changed_handler(request, exc):
+    return JSONResponse(
+        status_code=status.HTTP_409_CONFLICT,
+        content=jsonable_encoder({
+            "detail": "[RevisionIdWasChanged] El recurso fue modificado mientras se procesaba \
+tu solicitud. Por favor vuelve a cargarlo e intenta de nuevo"
+        })
+    )
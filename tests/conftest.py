@@ -0,0 +1,175 @@
+# Fixtures for the tests that run against a MongoDB instance (query plans and query budgets).
+#
+# Each test module gets a scratch database on the server at DB_URL (localhost by default), seeded
+# with the same data and dropped when the module finishes. The tests are skipped when the server
+# isn't reachable, unless TESTS_REQUIRE_DB is set (as CI does), in which case they fail.
+
+from datetime import datetime, timedelta
+import os
+
+# Settings without a sensible default in the app, they must exist before importing it
+os.environ.setdefault("DB_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "ug_groups")
+os.environ.setdefault("ORIGIN", "http://localhost:3000")
+os.environ.setdefault("SECRET_KEY", "tests")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("H_SECRET_KEY", "tests")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+for setting in ("EMAIL_HOST", "EMAIL_PORT", "EMAIL_USERNAME", "EMAIL_PASSWORD", "EMAIL_FROM"):
+    os.environ.setdefault(setting, "")
+
+# pylint: disable=C0413
+import pytest
+from decouple import config
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import ServerSelectionTimeoutError
+from beanie import init_beanie
+
+from main import beanie_models
+from app.registration.models import User, UserDraft, PwdResetToken, TokenRevocation
+from app.registration.utils import hash_password
+from app.groups.models import Group, GroupRecommendation, GroupActivity, MembershipTombstone
+from app.groups.cache import group_cache
+from app.posts.models import Post
+from app.uploads.models import UploadSession
+from app.miscellaneous.db_metrics import command_stats_listener
+
+
+DB_URL = config("DB_URL", cast=str)
+TEST_DB_NAME = f"{config('DB_NAME', cast=str)}_tests"
+TESTS_REQUIRE_DB = config("TESTS_REQUIRE_DB", default=False, cast=bool)
+
+SEED_USERS = 300
+SEED_GROUPS = 60
+SEED_MEMBERS_PER_GROUP = 14
+SEED_JOIN_REQUESTS_PER_GROUP = 5
+SEED_POSTS_PER_GROUP = 20
+SEED_ACTIVITY_PER_GROUP = 20
+SEED_PASSWORD = "tests"
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="module")
+async def mongo_client():
+    client = AsyncIOMotorClient(
+        DB_URL, event_listeners=[command_stats_listener], serverSelectionTimeoutMS=2000
+    )
+    try:
+        await client.admin.command("ping")
+    except ServerSelectionTimeoutError:
+        client.close()
+        if TESTS_REQUIRE_DB:
+            pytest.fail(f"MongoDB isn't reachable at {DB_URL}")
+        pytest.skip(f"MongoDB isn't reachable at {DB_URL}")
+
+    await client.drop_database(TEST_DB_NAME)
+    await init_beanie(database=client[TEST_DB_NAME], document_models=beanie_models)
+    group_cache.clear()
+
+    yield client
+
+    await client.drop_database(TEST_DB_NAME)
+    client.close()
+
+
+# Users, drafts, groups (each with an admin, members and join requests) and the posts, activity,
+# recommendations, tombstones, revocations and upload sessions of those. Returns (users, groups)
+@pytest.fixture(scope="module")
+async def seeded(mongo_client): # pylint: disable=W0613,W0621
+    password = await hash_password(SEED_PASSWORD)
+    await User.insert_many([
+        User(
+            firstName="Test", lastName=str(i), email=f"user{i}@example.com",
+            userType="student", division="DCI", academicLevel="bachelor", password=password
+        )
+        for i in range(SEED_USERS)
+    ])
+    users = await User.find_all().to_list()
+
+    await UserDraft.insert_many([
+        UserDraft(
+            firstName="Draft", lastName=str(i), userType="student", division="DCI",
+            password=password, email={
+                "value": f"draft{i}@example.com", "code": "abc123",
+                "codeIssuedAt": datetime.utcnow()
+            }
+        )
+        for i in range(SEED_USERS)
+    ])
+
+    # Still valid, so requesting another reset is rejected before sending any email
+    await PwdResetToken.insert_many([
+        PwdResetToken(userEmail=user.email, expirationDate=datetime.utcnow() + timedelta(hours=1))
+        for user in users[:SEED_USERS // 2]
+    ])
+
+    rosters = SEED_MEMBERS_PER_GROUP + SEED_JOIN_REQUESTS_PER_GROUP
+    await Group.insert_many([
+        Group(
+            name=f"Group {i}", description="", accessibility="private", whoCanPublish="anyone",
+            admins=[users[i % SEED_USERS]],
+            members=[
+                users[(i * 7 + j) % SEED_USERS] for j in range(1, SEED_MEMBERS_PER_GROUP + 1)
+            ],
+            joinRequests=[
+                users[(i * 7 + j) % SEED_USERS]
+                for j in range(SEED_MEMBERS_PER_GROUP + 1, rosters + 1)
+            ]
+        )
+        for i in range(SEED_GROUPS)
+    ])
+    groups = await Group.find_all().to_list()
+
+    now = datetime.utcnow()
+    await Post.insert_many([
+        Post(
+            groupId=group.id, author=group.members[i % SEED_MEMBERS_PER_GROUP], content="",
+            createdAt=now - timedelta(minutes=i)
+        )
+        for group in groups for i in range(SEED_POSTS_PER_GROUP)
+    ])
+
+    await GroupActivity.insert_many([
+        GroupActivity(
+            groupId=group.id, action="memberJoined",
+            actor=group.members[i % SEED_MEMBERS_PER_GROUP].ref.id,
+            createdAt=now - timedelta(minutes=i)
+        )
+        for group in groups for i in range(SEED_ACTIVITY_PER_GROUP)
+    ])
+
+    await GroupRecommendation.insert_many([
+        GroupRecommendation(
+            division="DCI", academicLevel="bachelor", groupId=group.id, score=i, name=group.name,
+            accessibility=group.accessibility, memberCount=group.memberCount
+        )
+        for i, group in enumerate(groups)
+    ])
+
+    await MembershipTombstone.insert_many([
+        MembershipTombstone(userId=user.id, groupId=group.id, createdAt=now - timedelta(days=i))
+        for i, (user, group) in enumerate(zip(users, groups))
+    ])
+
+    await TokenRevocation.insert_many([
+        TokenRevocation(
+            userId=user.id, jti=str(user.id), expiresAt=now + timedelta(days=1),
+            createdAt=now - timedelta(hours=i)
+        )
+        for i, user in enumerate(users)
+    ])
+
+    await UploadSession.insert_many([
+        UploadSession(
+            owner=user.id, filename="file.bin", contentType="application/octet-stream",
+            size=1024, sha256="0" * 64
+        )
+        for user in users
+    ])
+
+    return users, groups
+
@@ -0,0 +1,103 @@
+# Query budget tests.
+#
+# Each test sends a request to the app (with its middlewares, so DBMetricsMiddleware reports the
+# commands in Server-Timing) and fails if handling it took more database commands than its
+# budget. The seeded rosters and pages hold users and authors enough that fetching them one by
+# one (an N+1 regression) goes over the budget.
+#
+# Commands issued by background tasks, after the response started, aren't counted.
+
+import httpx
+import pytest
+
+from main import app
+from app.registration.router import generate_authentication_token
+from app.groups.cache import group_cache
+from app.miscellaneous.db_metrics import assert_query_budget
+
+
+pytestmark = pytest.mark.anyio
+
+
+def auth_headers(user_id) -> dict:
+    return {"Authorization": f"Bearer {generate_authentication_token(user_id)['accessToken']}"}
+
+
+@pytest.fixture(scope="module")
+async def client(seeded): # pylint: disable=W0613
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://tests"
+    ) as client: # pylint: disable=W0621
+        yield client
+
+
+# Reads go to the database, not to the groups cache
+@pytest.fixture(autouse=True)
+def clear_group_cache():
+    group_cache.clear()
+
+
+# The group, and its admins and members with a single query
+async def test_get_group_info(client, seeded):
+    _, groups = seeded
+    response = await client.get(f"/groups/{groups[0].id}/")
+    assert response.status_code == 200
+    assert_query_budget(response, 2)
+
+
+async def test_get_group_admins(client, seeded):
+    _, groups = seeded
+    response = await client.get(f"/groups/{groups[0].id}/admins/")
+    assert response.status_code == 200
+    assert_query_budget(response, 2)
+
+
+async def test_get_group_members(client, seeded):
+    _, groups = seeded
+    response = await client.get(f"/groups/{groups[0].id}/members/")
+    assert response.status_code == 200
+    assert len(response.json()["users"]) > 1
+    assert_query_budget(response, 2)
+
+
+# The group and the current user (loaded concurrently), and the requesting users
+async def test_get_group_join_requests(client, seeded):
+    _, groups = seeded
+    response = await client.get(
+        f"/groups/{groups[1].id}/join-requests/", headers=auth_headers(groups[1].admins[0].ref.id)
+    )
+    assert response.status_code == 200
+    assert len(response.json()["users"]) > 1
+    assert_query_budget(response, 3)
+
+
+# The group and the current user, the update of the rosters and the update of the counters
+async def test_approve_join_request(client, seeded):
+    _, groups = seeded
+    response = await client.post(
+        f"/groups/{groups[2].id}/approve-join-request/",
+        json=str(groups[2].joinRequests[0].ref.id),
+        headers=auth_headers(groups[2].admins[0].ref.id)
+    )
+    assert response.status_code == 200
+    assert_query_budget(response, 4)
+
+
+# The group and the current user, the page of posts and their authors
+async def test_get_group_feed(client, seeded):
+    _, groups = seeded
+    response = await client.get(
+        f"/groups/{groups[3].id}/posts/", headers=auth_headers(groups[3].admins[0].ref.id)
+    )
+    assert response.status_code == 200
+    assert len({post["author"]["id"] for post in response.json()["posts"]}) > 1
+    assert_query_budget(response, 4)
+
+
+# The current user, the ids of their groups, the page of posts and their authors
+async def test_get_my_feed(client, seeded):
+    users, _ = seeded
+    response = await client.get("/feed/", headers=auth_headers(users[1].id))
+    assert response.status_code == 200
+    assert response.json()["posts"]
+    assert_query_budget(response, 4)
@@ -0,0 +1,284 @@
+# Query plan regression tests.
+#
+# Sends a catalog of requests to the application's routes (in process, through an ASGI
+# transport) recording every command they send to mongo (see track_queries in db_metrics.py),
+# explains the recorded queries and fails if any of them scans a whole collection (COLLSCAN) or
+# examines many more documents than it returns. The plans checked are the ones of the commands
+# the routes actually issue, so a refactor can't silently turn an indexed lookup into a
+# collection scan, and changing a query in a route doesn't need any change here.
+#
+# When adding a new route, add a request for it to send_requests. Queries of background jobs,
+# which no request issues, are listed in get_job_queries.
+
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from beanie.operators import In
+from beanie.odm.queries.find import FindMany
+
+from app.registration.router import router as registration_router, generate_authentication_token
+from app.registration.models import User, TokenRevocation
+from app.groups.router import router as groups_router
+from app.groups.models import Group
+from app.posts.router import router as posts_router
+from app.uploads.router import router as uploads_router
+from app.uploads.models import UploadSession
+from app.miscellaneous.db_metrics import track_queries
+from conftest import TEST_DB_NAME, SEED_PASSWORD
+
+
+pytestmark = pytest.mark.anyio
+
+PAGE_SIZE = 5
+
+# Max ratio between examined documents (or index keys) and returned documents
+MAX_EXAMINED_RATIO = 3
+
+EXPLAINABLE_COMMANDS = {
+    "find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"
+}
+
+# Fields added by the driver that the explain command doesn't accept
+DRIVER_FIELDS = {"lsid", "$db", "$clusterTime", "$readPreference", "txnNumber", "writeConcern"}
+
+
+# The routers without the middlewares of the app, DBMetricsMiddleware would replace the stats
+# that record the commands
+def get_app() -> FastAPI:
+    app = FastAPI()
+    app.include_router(registration_router)
+    app.include_router(groups_router)
+    app.include_router(posts_router)
+    app.include_router(uploads_router)
+    return app
+
+
+def auth_headers(user_id) -> dict:
+    return {"Authorization": f"Bearer {generate_authentication_token(user_id)['accessToken']}"}
+
+
+# Sends the requests of the catalog, returning (name, recorded commands) for each of them.
+# Read-only requests go first, so the writes at the end don't change what the reads find
+async def send_requests(
+    client: httpx.AsyncClient, users: list[User], groups: list[Group]
+) -> list[tuple[str, list[tuple[str, dict]]]]:
+    recorded = []
+
+    async def request(name: str, method: str, url: str, **kwargs) -> httpx.Response:
+        with track_queries(record_commands=True) as stats:
+            response = await client.request(method, url, **kwargs)
+        recorded.append((f"{name} ({response.status_code})", stats.recorded))
+        return response
+
+    user, group = users[1], groups[0]
+    auth, admin_auth = auth_headers(user.id), auth_headers(group.admins[0].ref.id)
+
+    await request("me", "GET", "/me/", headers=auth)
+    await request("groups-iam-admin", "GET", "/groups-iam-admin/", headers=auth)
+    await request("groups-iam-member", "GET", "/groups-iam-member/", headers=auth)
+    response = await request("sync: full", "GET", "/sync/", headers=auth)
+    await request(
+        "sync: delta", "GET", "/sync/", params={"since": response.json()["cursor"]}, headers=auth
+    )
+
+    response = await request("feed", "GET", "/feed/", params={"limit": PAGE_SIZE}, headers=auth)
+    await request("feed: next page", "GET", "/feed/", params={
+        "limit": PAGE_SIZE, "cursor": response.json()["nextCursor"]
+    }, headers=auth)
+
+    await request("recommended groups", "GET", "/groups/recommended/", headers=auth)
+    await request("group info", "GET", f"/groups/{group.id}/", headers=auth)
+    await request("group admins", "GET", f"/groups/{group.id}/admins/", headers=auth)
+    await request("group members", "GET", f"/groups/{group.id}/members/", headers=auth)
+    await request(
+        "group join requests", "GET", f"/groups/{group.id}/join-requests/", headers=admin_auth
+    )
+
+    response = await request(
+        "group posts", "GET", f"/groups/{group.id}/posts/", params={"limit": PAGE_SIZE},
+        headers=admin_auth
+    )
+    await request("group posts: next page", "GET", f"/groups/{group.id}/posts/", params={
+        "limit": PAGE_SIZE, "cursor": response.json()["nextCursor"]
+    }, headers=admin_auth)
+
+    response = await request(
+        "group activity", "GET", f"/groups/{group.id}/activity/", params={"limit": PAGE_SIZE},
+        headers=admin_auth
+    )
+    await request("group activity: next page", "GET", f"/groups/{group.id}/activity/", params={
+        "limit": PAGE_SIZE, "cursor": response.json()["nextCursor"]
+    }, headers=admin_auth)
+
+    await request("signin", "POST", "/signin/", data={
+        "username": user.email, "password": SEED_PASSWORD
+    })
+    await request("signin: pending verification", "POST", "/signin/", data={
+        "username": "draft1@example.com", "password": SEED_PASSWORD
+    })
+    await request("signup: existing email", "POST", "/signup/", json={
+        "firstName": "Test", "lastName": "Test", "email": user.email, "userType": "student",
+        "division": "DCI", "password": SEED_PASSWORD, "passwordConfirm": SEED_PASSWORD
+    })
+    await request(
+        "verify-email: wrong code", "POST", "/verify-email/",
+        params={"email": "draft1@example.com"}, json={"code": "xyz789"}
+    )
+    await request(
+        "resend-verification-code: too soon", "GET", "/resend-verification-code/",
+        params={"email": "draft1@example.com"}
+    )
+    await request(
+        "request-password-reset: already requested", "POST", "/request-password-reset/",
+        json={"email": users[0].email}
+    )
+    await request(
+        "reset-password: invalid token", "POST", "/reset-password/",
+        params={"token": "00000000-0000-0000-0000-000000000000"}, json={"newPassword": "x"}
+    )
+
+    await request(
+        "patch profile", "PATCH", "/me/", json={"bio": "query plans", "division": "DCI"},
+        headers=auth
+    )
+    await request(
+        "patch group", "PATCH", f"/groups/{group.id}/", json={"description": "query plans"},
+        headers=admin_auth
+    )
+    await request("join group", "POST", f"/groups/{groups[-1].id}/join/", headers=auth)
+    await request(
+        "approve join request", "POST", f"/groups/{group.id}/approve-join-request/",
+        json=str(group.joinRequests[0].ref.id), headers=admin_auth
+    )
+
+    return recorded
+
+
+# Returns (name, query) for the queries of background jobs, built with the same expressions the
+# jobs use
+def get_job_queries(users: list[User]) -> list[tuple[str, FindMany]]:
+    return [
+        ("revocation list: refresh", TokenRevocation.find(
+            {"createdAt": {"$gte": datetime.utcnow() - timedelta(minutes=1)}}
+        )),
+        ("uploads sweeper: sessions by ids", UploadSession.find(
+            In(UploadSession.id, [user.id for user in users[:20]])
+        )),
+    ]
+
+
+def get_find_command(query: FindMany) -> dict:
+    command = {
+        "find": query.document_model.get_collection_name(),
+        "filter": query.get_filter_query()
+    }
+    if query.sort_expressions:
+        command["sort"] = dict(query.sort_expressions)
+    if query.limit_number:
+        command["limit"] = query.limit_number
+    return command
+
+
+# Returns the commands to explain for a recorded one, none if it isn't a query. Updates and
+# deletes carry a list of statements, and explain takes a single one
+def get_explainable(command: dict) -> list[dict]:
+    if next(iter(command)) not in EXPLAINABLE_COMMANDS:
+        return []
+
+    command = {key: value for key, value in command.items() if key not in DRIVER_FIELDS}
+    for statements in ("updates", "deletes"):
+        if statements in command:
+            return [{**command, statements: [statement]} for statement in command[statements]]
+    return [command]
+
+
+# Aggregations nest the plan and stats of their first stage, so they are looked up at any depth
+def find_field(document, field: str):
+    if isinstance(document, dict):
+        if field in document:
+            return document[field]
+        values = document.values()
+    elif isinstance(document, list):
+        values = document
+    else:
+        return None
+
+    for value in values:
+        if (found := find_field(value, field)) is not None:
+            return found
+    return None
+
+
+def get_stages(plan: dict) -> list[str]:
+    stages = [plan["stage"]]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += get_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += get_stages(child)
+    return stages
+
+
+# Returns the problems of the plan of the command, none if it's fine
+async def check_command(database, command: dict) -> list[str]:
+    explanation = await database.command({"explain": command, "verbosity": "executionStats"})
+    stages = get_stages(find_field(explanation, "queryPlanner")["winningPlan"])
+    stats = find_field(explanation, "executionStats")
+    examined = max(stats["totalDocsExamined"], stats["totalKeysExamined"])
+    returned = max(stats["nReturned"], 1)
+
+    problems = []
+    if "COLLSCAN" in stages:
+        problems.append("COLLSCAN")
+    # Counts examine every key they count
+    if "COUNT_SCAN" not in stages and examined > returned * MAX_EXAMINED_RATIO:
+        problems.append(f"examined {examined} to return {stats['nReturned']}")
+    return [f"{problem} ({' > '.join(stages)})" for problem in problems]
+
+
+def test_explainable_commands():
+    update = {
+        "update": "groups", "updates": [{"q": {"_id": 1}}, {"q": {"_id": 2}}], "ordered": True,
+        "lsid": {}, "$db": "tests"
+    }
+    assert get_explainable(update) == [
+        {"update": "groups", "updates": [{"q": {"_id": 1}}], "ordered": True},
+        {"update": "groups", "updates": [{"q": {"_id": 2}}], "ordered": True}
+    ]
+    assert get_explainable({"insert": "groups", "documents": []}) == []
+    assert find_field(
+        {"stages": [{"$cursor": {"queryPlanner": {"winningPlan": {"stage": "IXSCAN"}}}}]},
+        "queryPlanner"
+    ) == {"winningPlan": {"stage": "IXSCAN"}}
+
+
+async def test_query_plans(mongo_client, seeded):
+    users, groups = seeded
+
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=get_app()), base_url="http://tests"
+    ) as client:
+        recorded = await send_requests(client, users, groups)
+
+    checks = []
+    for request_name, commands in recorded:
+        for database_name, recorded_command in commands:
+            for command in get_explainable(recorded_command):
+                command_name = next(iter(command))
+                checks.append((
+                    f"{request_name}: {command_name} {command[command_name]}", database_name,
+                    command
+                ))
+    checks += [
+        (name, TEST_DB_NAME, get_find_command(query)) for name, query in get_job_queries(users)
+    ]
+    assert checks, "No queries were recorded"
+
+    failures = [
+        f"{name}: {problem}"
+        for name, database_name, command in checks
+        for problem in await check_command(mongo_client[database_name], command)
+    ]
+    assert not failures, "Queries with bad plans:\n" + "\n".join(failures)